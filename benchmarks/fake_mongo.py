@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# fake_mongo.py
+# stand-in for the mongo shell for benchmarks, it understands the
+# commands mongrate.py sends (session or --eval, load bundles, tryLoad
+# and tryFunc) and stores migrations in MongoDB with pymongo, so the
+# time measured is mongrate's own and not the shell's
+#
+# MONGRATE_FAKE_WORK_MS sets how long each up()/down() pretends to take
+#
+
+import json
+import os, sys
+import re
+import time
+import pymongo
+
+MONGRATE_DB = 'admin'
+MONGRATE_WORKING_SCRIPT_COLL = 'mongrate.scripts'
+
+WORK_MS = int(os.environ.get('MONGRATE_FAKE_WORK_MS','0'))
+
+def parse_migration(path):
+    """_id and runAfter of a migration, the same way the plan action reads them"""
+    content = open(path).read()
+    doc = {}
+    m = re.search(r"""['"]?_id['"]?\s*:\s*['"]([^'"]+)['"]""",content)
+    if m:
+        doc['_id'] = m.group(1)
+    m = re.search(r"""['"]?runAfter['"]?\s*:\s*\[([^\]]*)\]""",content)
+    if m:
+        doc['runAfter'] = re.findall(r"""['"]([^'"]+)['"]""",m.group(1))
+    return doc
+
+def load_migration(mongo, path, blob_hash):
+    doc = parse_migration(path)
+    if not '_id' in doc:
+        raise Exception('%s missing _id' % path)
+    doc['mongrateFile'] = path
+    doc['mongrateHash'] = blob_hash
+    mongo[MONGRATE_DB][MONGRATE_WORKING_SCRIPT_COLL].insert_one(doc)
+
+def load_bundle(mongo, bundle):
+    """A bundle written by __load_scripts, prints a marker per script"""
+    content = open(bundle).read()
+    paths = [json.loads(p) for p in re.findall(r'^    load\((".*")\);$',content,re.M)]
+    hashes = re.findall(r'mongrateHash = (null|"[0-9a-f]*");',content)
+    markers = re.findall(r"print\('(__MONGRATE_LOADED__) (\d+)'\);",content)
+    for i in range(len(paths)):
+        try:
+            load_migration(mongo,paths[i],json.loads(hashes[i]))
+            print '%s %s' % markers[i]
+        except Exception as exp:
+            print exp
+            print '__MONGRATE_LOAD_FAILED__ %s' % markers[i][1]
+
+def evaluate(mongo, eval_string):
+    m = re.match(r'^load\((".*")\);$',eval_string)
+    if m:
+        load_bundle(mongo,json.loads(m.group(1)))
+        return
+    if 'mongrate.tryLoad();' in eval_string:
+        m = re.match(r'^mongrate = (\{.*\});db=',eval_string)
+        try_load = json.loads(m.group(1))['tryLoad']
+        path = re.search(r"mongrateFile = '([^']*)';",try_load).group(1)
+        blob_hash = json.loads(re.search(r'mongrateHash = (null|"[0-9a-f]*");',try_load).group(1))
+        load_migration(mongo,path,blob_hash)
+        return
+    if 'mongrate.tryFunc();' in eval_string:
+        time.sleep(WORK_MS / 1000.0)
+        return
+
+def session(mongo):
+    """Commands arrive one per line on stdin, see MongoShellSession.send"""
+    command = re.compile(r"try \{ eval\((\".*\")\); print\('([^']*)' \+ '([^']*)'\); \} catch\(error\) \{ print\(error\); print\('([^']*)' \+ '([^']*)'\); \}$")
+    for line in iter(sys.stdin.readline,''):
+        line = line.strip()
+        if line == 'quit()':
+            break
+        m = command.search(line)
+        if not m:
+            continue
+        try:
+            evaluate(mongo,json.loads(m.group(1)))
+            print m.group(2) + m.group(3)
+        except Exception as exp:
+            print exp
+            print m.group(4) + m.group(5)
+        sys.stdout.flush()
+
+def main():
+    args = [a for a in sys.argv[1:] if not a in ('--quiet','--norc')]
+    mongo = pymongo.MongoClient(args[0])
+    if '--eval' in args:
+        try:
+            evaluate(mongo,args[args.index('--eval') + 1])
+        except Exception as exp:
+            print exp
+            sys.exit(1)
+    else:
+        session(mongo)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+#
+# scaling.py
+# how mongrate.py scales with the number of migrations, builds synthetic
+# git repos and times migrate's phases (--profile) against a local MongoDB
+# with fake_mongo.py standing in for the mongo shell
+#
+# python benchmarks/scaling.py --mongodb mongodb://localhost:27017/bench --sizes 10,100,1000 --shape layers
+#
+# the MongoDB instance should be a scratch one, mongrate's admin
+# collections are reset for every case
+#
+
+import argparse
+import datetime
+import json
+import os, sys
+import random
+import shutil
+import tempfile
+import time
+import yaml
+import pymongo
+from subprocess import Popen, PIPE, STDOUT
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MONGRATE = os.path.join(HERE,os.pardir,'mongrate.py')
+
+MIGRATION_HOME = 'db/mongo/migrations'
+MIGRATION_COMMON_HOME = 'common'
+
+SHAPES = ('none','chain','fan','layers','random')
+
+def run_after(shape, prior, rnd):
+    """The runAfter list of the next migration for a graph shape, prior are the earlier ones it can see"""
+    if not prior or shape == 'none':
+        return []
+    if shape == 'chain':
+        return [prior[-1]]
+    if shape == 'fan':
+        return [prior[0]]
+    if shape == 'layers':
+        # ten migrations a layer, each after all of the layer before
+        layer = len(prior) / 10
+        if layer == 0:
+            return []
+        return prior[(layer-1)*10:layer*10]
+    return rnd.sample(prior,min(len(prior),rnd.randint(1,3)))
+
+def git(repo, *args):
+    proc = Popen(["git"] + list(args), cwd=repo, stdout=PIPE, stderr=STDOUT, universal_newlines=True)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise Exception('git %s failed: %s' % (' '.join(args),output))
+    return output.strip()
+
+def make_repo(repo, count, commits, shape, dcs, seed):
+    """Create a repo with count migrations spread over commits commits, returns (base commit, migration ids)"""
+    rnd = random.Random(seed)
+    git(repo,'init','-q')
+    git(repo,'config','user.email','bench@mongrate')
+    git(repo,'config','user.name','mongrate bench')
+    f = open(os.path.join(repo,'README'),'w')
+    f.write('mongrate benchmark repo\n')
+    f.close()
+    git(repo,'add','README')
+    git(repo,'commit','-q','-m','base')
+    base = git(repo,'rev-parse','HEAD')
+    folders = [MIGRATION_COMMON_HOME] + ['dc%s' % d for d in range(dcs)]
+    for folder in folders:
+        os.makedirs(os.path.join(repo,MIGRATION_HOME,folder))
+    ids = ['m%06d' % i for i in range(count)]
+    per_commit = max(1,count / max(1,commits))
+    # a migration only runs after ones in common or its own folder, so
+    # each distribution center's graph is complete on its own
+    prior = dict([(folder,[]) for folder in folders])
+    for i in range(count):
+        folder = folders[i % len(folders)]
+        visible = sorted(prior[MIGRATION_COMMON_HOME] + (prior[folder] if folder != MIGRATION_COMMON_HOME else []))
+        path = os.path.join(MIGRATION_HOME,folder,ids[i] + '.js')
+        f = open(os.path.join(repo,path),'w')
+        f.write("migration = {\n")
+        f.write("  '_id' : '%s',\n" % ids[i])
+        f.write("  'runAfter' : [%s],\n" % ', '.join(["'%s'" % x for x in run_after(shape,visible,rnd)]))
+        f.write("  'up' : function() {\n      },\n")
+        f.write("  'down' : function() {\n      },\n")
+        f.write("}\n\nmongrate.exports = migration;\n")
+        f.close()
+        prior[folder].append(ids[i])
+        git(repo,'add',path)
+        if (i + 1) % per_commit == 0 or i == count - 1:
+            git(repo,'commit','-q','-m','migrations up to %s' % ids[i])
+    return base, ids
+
+def run_mongrate(conf, env, *args):
+    shell_args = [sys.executable,MONGRATE,'-f',conf,'--no-server'] + list(args)
+    proc = Popen(shell_args, stdout=PIPE, stderr=STDOUT, env=env, universal_newlines=True)
+    output = proc.communicate()[0]
+    return proc.returncode, output
+
+def run_case(args, count, shape, env):
+    work = tempfile.mkdtemp(prefix='mongrate-bench-')
+    try:
+        repo = os.path.join(work,'repo')
+        os.makedirs(repo)
+        started = time.time()
+        base, ids = make_repo(repo,count,args.commits,shape,args.dcs,args.seed)
+        setup_seconds = time.time() - started
+        conf = os.path.join(work,'mongrate.conf')
+        f = open(conf,'w')
+        yaml.safe_dump({ 'mongodb' : args.mongodb,
+                         'git' : repo,
+                         'migration_home' : MIGRATION_HOME,
+                         'migration_common_home' : MIGRATION_COMMON_HOME,
+                         'logfile' : os.path.join(work,'mongrate.log'),
+                         'loglevel' : 'INFO' },f)
+        f.close()
+        rc, output = run_mongrate(conf,env,'-a','initialize','--force')
+        if rc != 0:
+            raise Exception('initialize failed: %s' % output)
+        # migrate from the base commit, so every migration is in the diff
+        mongo = pymongo.MongoClient(args.mongodb)
+        mongo['admin']['mongrate.status'].update_one({ '_id' : 'COMMIT' },{ '$set' : { 'value' : base } })
+        for coll in ('mongrate.scripts','mongrate.checkpoints'):
+            mongo['admin'][coll].drop()
+        runs = []
+        for label in ['cold','warm'][:args.repeat]:
+            migrate_args = ['-a','migrate','--git-commit',base,'--profile','--jobs',str(args.jobs)]
+            if args.dcs:
+                migrate_args += ['--distributionCenter','dc0']
+            rc, output = run_mongrate(conf,env,*migrate_args)
+            if rc != 0:
+                raise Exception('migrate failed: %s' % output)
+            profile = json.loads(output)
+            runs.append({ 'run' : label,
+                          'seconds' : profile['seconds'],
+                          'phases' : profile['phases'],
+                          'scripts' : len(profile['scripts']) })
+        return { 'migrations' : count,
+                 'shape' : shape,
+                 'commits' : args.commits,
+                 'distributionCenters' : args.dcs,
+                 'setup_seconds' : round(setup_seconds,3),
+                 'runs' : runs }
+    finally:
+        shutil.rmtree(work)
+
+def main():
+    parser = argparse.ArgumentParser(description='mongrate scaling benchmark')
+    parser.add_argument("--mongodb",default='mongodb://localhost:27017/mongrate_bench',help='scratch MongoDB to run against')
+    parser.add_argument("--sizes",default='10,100,500',help='comma separated numbers of migrations, default is 10,100,500')
+    parser.add_argument("--shape",action='append',choices=SHAPES,help='runAfter graph shape, can be repeated, default is layers')
+    parser.add_argument("--commits",type=int,default=10,help='commits the migrations are spread over, default is 10')
+    parser.add_argument("--dcs",type=int,default=2,help='distribution center folders, default is 2')
+    parser.add_argument("--jobs",type=int,default=1,help='passed to migrate --jobs, default is 1')
+    parser.add_argument("--work-ms",type=int,default=0,help='time each fake up() takes, default is 0')
+    parser.add_argument("--repeat",type=int,choices=(1,2),default=2,help='1 for a cold run only, 2 to also time a warm rerun, default is 2')
+    parser.add_argument("--seed",type=int,default=1,help='random seed for the random shape')
+    parser.add_argument("--output",help='write results as JSON to this file as well as stdout')
+    args = parser.parse_args()
+    # 'mongo' on the PATH is the stand-in
+    bin_dir = tempfile.mkdtemp(prefix='mongrate-bench-bin-')
+    f = open(os.path.join(bin_dir,'mongo'),'w')
+    f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable,os.path.join(HERE,'fake_mongo.py')))
+    f.close()
+    os.chmod(os.path.join(bin_dir,'mongo'),0755)
+    env = dict(os.environ)
+    env['PATH'] = bin_dir + os.pathsep + env.get('PATH','')
+    env['MONGRATE_FAKE_WORK_MS'] = str(args.work_ms)
+    version = Popen(["git","describe","--always","--dirty"], cwd=HERE, stdout=PIPE, universal_newlines=True).communicate()[0].strip()
+    results = { 'version' : version,
+                'date' : str(datetime.datetime.now()),
+                'python' : sys.version.split()[0],
+                'jobs' : args.jobs,
+                'cases' : [] }
+    try:
+        for shape in args.shape or ['layers']:
+            for count in [int(n) for n in args.sizes.split(',')]:
+                print >> sys.stderr, 'running %s migrations shape=%s' % (count,shape)
+                results['cases'].append(run_case(args,count,shape,env))
+    finally:
+        shutil.rmtree(bin_dir)
+    print json.dumps(results,indent=2)
+    if args.output:
+        f = open(args.output,'w')
+        json.dump(results,f,indent=2)
+        f.close()
+
+if __name__ == '__main__':
+    main()
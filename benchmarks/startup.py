@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# startup.py
+# time from starting mongrate.py to the first line of output from the
+# action itself, not the startup banner, and to exit, for each action
+#
+# python benchmarks/startup.py -f mongrate.conf --git-commit HEAD --runs 10
+#
+
+import argparse
+import json
+import os, sys
+import shutil
+import tempfile
+import time
+import uuid
+import yaml
+from subprocess import Popen, PIPE, STDOUT
+
+MONGRATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'mongrate.py')
+
+ACTIONS = ['generate_template_migration','status','plan']
+
+# lines each action prints or logs once it has done some work, the
+# startup banner names the action so these are more specific
+FIRST_OUTPUT = { 'generate_template_migration' : ('template migration name = ',),
+                 'status' : ('Current git status',),
+                 'plan' : ('level 0: ','plan for ','plan has '),
+                 'bundle' : ('bundle of ','plan has '),
+                 'migrate' : ('migrate rollback=',),
+                 'verify' : (' differences in ',) }
+
+def run_once(python, config, action, extra):
+    """Returns (seconds to the action's first line of output, seconds to exit, returncode)"""
+    shell_args = [python,MONGRATE,'-f',config,'-a',action] + extra
+    started = time.time()
+    proc = Popen(shell_args, stdout=PIPE, stderr=STDOUT, universal_newlines=True)
+    first_output = None
+    for line in iter(proc.stdout.readline,''):
+        if [m for m in FIRST_OUTPUT[action] if m in line]:
+            first_output = time.time() - started
+            break
+    proc.stdout.read()
+    proc.wait()
+    if first_output is None:
+        # failed before getting that far, count it as the whole run
+        first_output = time.time() - started
+    return first_output, time.time() - started, proc.returncode
+
+def summarize(times):
+    times = sorted(times)
+    return { 'min' : round(times[0],4),
+             'median' : round(times[len(times)/2],4),
+             'max' : round(times[-1],4) }
+
+def main():
+    parser = argparse.ArgumentParser(description='mongrate startup benchmark')
+    parser.add_argument("-f","--config",default="./mongrate.conf",help='mongrate configuration file')
+    parser.add_argument("-a","--action",action='append',choices=sorted(FIRST_OUTPUT.keys()),
+                        help='action to time, can be repeated, default is %s' % ', '.join(ACTIONS))
+    parser.add_argument("--git-commit",help="passed to actions which need it, plan is skipped without it")
+    parser.add_argument("--runs",type=int,default=5,help='runs of each action, default is 5')
+    parser.add_argument("--python",default=sys.executable,help='python to run mongrate.py with')
+    parser.add_argument("--output",help='write results as JSON to this file as well as stdout')
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config))
+    # log to stdout, where the first lines are looked for
+    config.pop('logfile',None)
+    scratch = tempfile.mkdtemp(prefix='mongrate-startup-')
+    bench_config_file = os.path.join(scratch,'mongrate-bench.conf')
+    f = open(bench_config_file,'w')
+    yaml.safe_dump(config,f)
+    f.close()
+    # generate_template_migration writes files, so it gets a throw away
+    # migration home rather than the real repo
+    os.makedirs(os.path.join(scratch,config['migration_home'],config['migration_common_home']))
+    scratch_config = dict(config)
+    scratch_config['git'] = scratch
+    scratch_config_file = os.path.join(scratch,'mongrate.conf')
+    f = open(scratch_config_file,'w')
+    yaml.safe_dump(scratch_config,f)
+    f.close()
+    results = { 'python' : args.python, 'runs' : args.runs, 'actions' : {} }
+    try:
+        for action in args.action or ACTIONS:
+            if action == 'generate_template_migration':
+                conf = scratch_config_file
+                extra = ['--migration-id','startup-%s' % uuid.uuid4()]
+            else:
+                conf = bench_config_file
+                extra = ['--no-server']
+            if action in ('plan','migrate','bundle'):
+                if not args.git_commit:
+                    print >> sys.stderr, 'skipping %s, it needs --git-commit' % action
+                    continue
+                extra += ['--git-commit',args.git_commit]
+            if action == 'migrate':
+                extra.append('--dry-run')
+            first_output = []
+            total = []
+            returncodes = set()
+            for i in range(args.runs):
+                f, t, rc = run_once(args.python,conf,action,extra)
+                first_output.append(f)
+                total.append(t)
+                returncodes.add(rc)
+            results['actions'][action] = { 'first_output' : summarize(first_output),
+                                           'total' : summarize(total),
+                                           'returncodes' : sorted(returncodes) }
+    finally:
+        shutil.rmtree(scratch)
+    print json.dumps(results,indent=2)
+    if args.output:
+        f = open(args.output,'w')
+        json.dump(results,f,indent=2)
+        f.close()
+
+if __name__ == '__main__':
+    main()
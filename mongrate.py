@@ -5,17 +5,435 @@
 #
 #
 
+# git, pymongo, toposort and multiprocessing are imported by the
+# functions which use them, so actions which don't need them start quicker
 import yaml
 import logging
 import sys, os
 import argparse
-from git import *
-import pymongo
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, STDOUT
 import json
 import datetime
-from toposort import toposort, toposort_flatten
 import uuid
+import hashlib
+import socket
+from StringIO import StringIO
+import gzip
+import copy
+import time
+import tempfile
+import imp
+import ast
+import re
+import threading
+import Queue
+from collections import deque
+
+class ShellOutput():
+    """Reads a mongo shell's output on a thread, so lines can be logged as they
+    arrive and a command can be timed out. Only the last TAIL_LINES lines are
+    kept, for error reports"""
+
+    TAIL_LINES = 200
+    HEARTBEAT = 60
+
+    def __init__(self, stream, logger):
+        self.logger = logger
+        self.lines = Queue.Queue()
+        reader = threading.Thread(target=self.__read, args=(stream,))
+        reader.daemon = True
+        reader.start()
+
+    def __read(self, stream):
+        for line in iter(stream.readline, ''):
+            self.lines.put(line.rstrip('\n'))
+        self.lines.put(None)
+
+    def follow(self, label, stop=(), on_line=None, timeout=None, heartbeat=HEARTBEAT):
+        """Log lines until the end of the stream or a line in stop, returns
+        (the stop line or None at end of stream, tail, timed_out)"""
+        tail = deque(maxlen=self.TAIL_LINES)
+        started = time.time()
+        last_beat = started
+        while True:
+            now = time.time()
+            # lines are only logged at DEBUG, so the heartbeat goes on a
+            # timer whether or not the command is printing
+            if now - last_beat >= heartbeat:
+                last_beat = now
+                self.logger.info('%s still running, %ss elapsed%s' % (label, int(now - started),
+                                 ', last output: %s' % tail[-1] if tail else ''))
+            wait = heartbeat - (now - last_beat)
+            if timeout:
+                wait = min(wait, timeout - (now - started))
+            if timeout and wait <= 0:
+                self.logger.error('%s timed out after %ss' % (label, timeout))
+                return None, '\n'.join(tail), True
+            try:
+                line = self.lines.get(True, max(wait,0.01))
+            except Queue.Empty:
+                continue
+            if line is None:
+                return None, '\n'.join(tail), False
+            if line in stop:
+                return line, '\n'.join(tail), False
+            self.logger.debug('[%s] %s' % (label, line))
+            tail.append(line)
+            if on_line is not None:
+                on_line(line)
+
+
+class MongoShellSession():
+    """A long-lived mongo shell process, commands are sent over stdin and
+    each one ends by printing an ok or fail marker so we can tell how it went"""
+
+    OK_MARKER = '__MONGRATE_OK__'
+    FAIL_MARKER = '__MONGRATE_FAIL__'
+
+    def __init__(self, mongodb, logger, heartbeat=ShellOutput.HEARTBEAT):
+        self.mongodb = mongodb
+        self.logger = logger
+        self.heartbeat = heartbeat
+        self.proc = None
+
+    def start(self):
+        shell_args = ["mongo", "--quiet", "--norc", self.mongodb]
+        self.logger.debug("starting mongo shell session")
+        self.proc = Popen(shell_args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, universal_newlines=True)
+        self.output = ShellOutput(self.proc.stdout, self.logger)
+        # remember the connection's db, migrations may 'use' other
+        # databases and each command should start from the same place
+        ok, output = self.send("__mongrate_default_db = db;", reset_db=False)
+        if not ok:
+            self.close()
+            raise Exception("Unable to start mongo shell session: %s" % output)
+        self.logger.debug("mongo shell session started pid=%s" % self.proc.pid)
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def send(self, eval_string, reset_db=True, label='mongo', on_line=None, timeout=None):
+        """Evaluate eval_string in the session, returns (ok, output) where output is the tail of what the command printed"""
+        if not self.is_alive():
+            return False, 'mongo shell session is not running'
+        token = str(uuid.uuid4())
+        ok_line = '%s %s' % (self.OK_MARKER, token)
+        fail_line = '%s %s' % (self.FAIL_MARKER, token)
+        # markers are split so an echo of the command never matches
+        cmd = ''
+        if reset_db:
+            cmd += "db = __mongrate_default_db;"
+        cmd += "try { eval(%s); print('%s' + '%s'); }" % (json.dumps(eval_string), ok_line[:4], ok_line[4:])
+        cmd += " catch(error) { print(error); print('%s' + '%s'); }" % (fail_line[:4], fail_line[4:])
+        try:
+            self.proc.stdin.write(cmd + '\n')
+            self.proc.stdin.flush()
+        except IOError as exp:
+            self.logger.error(exp)
+            return False, str(exp)
+        line, output, timed_out = self.output.follow(label, (ok_line,fail_line), on_line, timeout, self.heartbeat)
+        if timed_out:
+            # the session can't be trusted with the command still running
+            self.logger.error('killing mongo shell session pid=%s, operations it started may still be running on the server' % self.proc.pid)
+            self.proc.kill()
+            self.proc.wait()
+            return False, output
+        if line is None:
+            self.proc.wait()
+            return False, output + '\nmongo shell session exited returncode=%s' % self.proc.returncode
+        return line == ok_line, output
+
+    def close(self):
+        if not self.is_alive():
+            return
+        self.logger.debug("closing mongo shell session pid=%s" % self.proc.pid)
+        try:
+            self.proc.stdin.write('quit()\n')
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        self.proc.wait()
+
+
+class ReplicationThrottle():
+    """Slows down batch work while the secondaries of a replica set fall
+    behind the primary. Below half of max_lag batches run at full speed,
+    above it a growing delay is added after each batch and at max_lag work
+    is paused until the secondaries are back under half of max_lag"""
+
+    MIN_DELAY = 0.1
+    MAX_DELAY = 5
+    PAUSE_CHECK = 5
+
+    def __init__(self, mongo, max_lag, logger):
+        self.mongo = mongo
+        self.max_lag = max_lag
+        self.logger = logger
+        self.delay = 0
+        self.started = time.time()
+        self.stats = { 'maxLagAllowed' : max_lag, 'lag' : 0, 'maxLag' : 0, 'checks' : 0,
+                       'pauses' : 0, 'pausedSeconds' : 0, 'slowedSeconds' : 0, 'documents' : 0 }
+
+    def get_lag(self):
+        """Seconds the furthest behind secondary is behind the primary, None if this isn't a replica set"""
+        import pymongo.errors
+        try:
+            status = self.mongo['admin'].command('replSetGetStatus')
+        except pymongo.errors.OperationFailure as exp:
+            self.logger.info('replSetGetStatus failed, not throttling: %s' % exp)
+            return None
+        primary = [m['optimeDate'] for m in status['members'] if m['state'] == 1]
+        secondaries = [m['optimeDate'] for m in status['members'] if m['state'] == 2]
+        if not primary:
+            return 0
+        lag = max([(primary[0] - s).total_seconds() for s in secondaries] + [0])
+        self.stats['checks'] += 1
+        self.stats['lag'] = lag
+        self.stats['maxLag'] = max(self.stats['maxLag'],lag)
+        return lag
+
+    def wait(self, documents=0):
+        """Called after each batch of documents, sleeps as long as the lag asks for"""
+        self.stats['documents'] += documents
+        if self.max_lag is None:
+            return
+        lag = self.get_lag()
+        if lag is None:
+            self.max_lag = None
+            return
+        if lag >= self.max_lag:
+            self.logger.info('secondaries are %ss behind, pausing until they are under %ss' % (lag,self.max_lag / 2.0))
+            self.stats['pauses'] += 1
+            started = time.time()
+            while lag is not None and lag >= self.max_lag / 2.0:
+                time.sleep(self.PAUSE_CHECK)
+                lag = self.get_lag()
+            self.stats['pausedSeconds'] += round(time.time() - started,3)
+            self.logger.info('secondaries caught up after %ss, carrying on' % round(time.time() - started,3))
+            self.delay = self.MIN_DELAY
+        elif lag >= self.max_lag / 2.0:
+            self.delay = min(self.MAX_DELAY,max(self.MIN_DELAY,self.delay * 2))
+        elif self.delay:
+            self.delay = self.delay / 2 if self.delay > self.MIN_DELAY else 0
+        if self.delay:
+            self.logger.debug('secondaries are %ss behind, sleeping %ss' % (lag,self.delay))
+            time.sleep(self.delay)
+            self.stats['slowedSeconds'] += self.delay
+
+    def add(self, stats):
+        """Count the work done by another throttle, like a parallel_update worker's"""
+        for k in ('pauses','pausedSeconds','slowedSeconds','documents','checks'):
+            self.stats[k] += stats[k]
+        self.stats['maxLag'] = max(self.stats['maxLag'],stats['maxLag'])
+
+    def get_stats(self):
+        """Lag, pauses and throughput for the history"""
+        stats = dict(self.stats)
+        stats['seconds'] = round(time.time() - self.started,3)
+        stats['docsPerSecond'] = round(stats['documents'] / stats['seconds'],1) if stats['seconds'] else 0
+        return stats
+
+
+class MigrationHelper():
+    """Helpers for python migrations, each migration module gets one as it's
+    'mongrate' global, like the mongrate object javascript migrations get"""
+
+    BATCH_SIZE = 1000
+    RANGE_RETRIES = 2
+    # sampled documents per range when splitVector can't be used
+    RANGE_SAMPLES = 10
+
+    def __init__(self, mongo, migration_id, func, logger, max_lag=None, mongodb=None, can_fork=False):
+        self.mongo = mongo
+        self.mongodb = mongodb
+        # forking is only safe when no other threads are running migrations
+        self.can_fork = can_fork
+        self.migration_id = migration_id
+        self.func = func
+        self.logger = logger
+        self.replication_throttle = ReplicationThrottle(mongo,max_lag,logger)
+
+    def throttle(self, documents=0):
+        """Call after writing a batch of documents in your own loops, waits while
+        the secondaries are more than --max-lag seconds behind, batch_update
+        does this for you"""
+        self.replication_throttle.wait(documents)
+
+    def batch_update(self, db_name, coll_name, fn, query=None, batch_size=BATCH_SIZE, name=None):
+        """Apply fn(doc) to every document matching query in _id order, batch_size
+        documents at a time. fn returns an update like { '$set' : {...} } or None
+        to skip the doc. The last _id done is checkpointed in admin so a rerun
+        carries on from there, returns the number of documents processed"""
+        import pymongo
+        key = '.'.join([self.migration_id,self.func,db_name,coll_name])
+        if name:
+            key += '.' + name
+        checkpoints = self.mongo[Mongrate.MONGRATE_DB][Mongrate.MONGRATE_CHECKPOINT_COLL]
+        cp = checkpoints.find_one({ '_id' : key }) or { 'processed' : 0 }
+        if cp.get('done'):
+            self.logger.info('batch_update %s already complete' % key)
+            return cp['processed']
+        if 'lastId' in cp:
+            self.logger.info('batch_update %s resuming after %s' % (key,cp['lastId']))
+        coll = self.mongo[db_name][coll_name]
+        query = query or {}
+        while True:
+            q = query
+            if 'lastId' in cp:
+                q = { '$and' : [ query, { '_id' : { '$gt' : cp['lastId'] } } ] }
+            docs = list(coll.find(q).sort('_id',pymongo.ASCENDING).limit(batch_size))
+            if not docs:
+                break
+            ops = []
+            for doc in docs:
+                u = fn(doc)
+                if u:
+                    ops.append(pymongo.UpdateOne({ '_id' : doc['_id'] },u))
+            if ops:
+                wr = coll.bulk_write(ops,ordered=False)
+                self.logger.debug('batch_update %s writeResult=%s' % (key,wr.bulk_api_result))
+            cp['lastId'] = docs[-1]['_id']
+            cp['processed'] += len(docs)
+            u = { '$set' : { 'migration' : self.migration_id, 'lastId' : cp['lastId'], 'processed' : cp['processed'], 'ts' : datetime.datetime.now() } }
+            checkpoints.update_one({ '_id' : key },u,upsert=True)
+            self.logger.info('batch_update %s processed %s' % (key,cp['processed']))
+            self.throttle(len(docs))
+        u = { '$set' : { 'migration' : self.migration_id, 'done' : True, 'processed' : cp['processed'], 'ts' : datetime.datetime.now() } }
+        checkpoints.update_one({ '_id' : key },u,upsert=True)
+        return cp['processed']
+
+    def parallel_update(self, db_name, coll_name, fn, query=None, batch_size=BATCH_SIZE, name=None,
+                        key='_id', workers=None, ranges=None, retries=RANGE_RETRIES):
+        """batch_update split over ranges of key (_id or the shard key) run in a pool
+        of worker processes, each with it's own connection. fn must be a module level
+        function of the migration. The ranges are saved with the checkpoints so a rerun,
+        or a retry of a failed range, works on the same ones. Not available with
+        --jobs > 1 or --fleet, returns the number of documents processed"""
+        import multiprocessing
+        if not self.mongodb:
+            raise Exception('parallel_update needs the connection string for it\'s workers')
+        if not self.can_fork:
+            raise Exception('parallel_update forks worker processes, it can\'t be used with --jobs > 1 or --fleet, use batch_update')
+        workers = workers or multiprocessing.cpu_count()
+        ranges = ranges or workers * 4
+        label = '.'.join(filter(None,[self.migration_id,self.func,db_name,coll_name,name]))
+        cp_key = label + '.ranges'
+        checkpoints = self.mongo[Mongrate.MONGRATE_DB][Mongrate.MONGRATE_CHECKPOINT_COLL]
+        cp = checkpoints.find_one({ '_id' : cp_key })
+        if cp:
+            bounds = cp['bounds']
+            self.logger.info('parallel_update %s reusing %s ranges' % (label,len(bounds) + 1))
+        else:
+            bounds = self.get_range_bounds(db_name,coll_name,key,ranges)
+            u = { '$set' : { 'migration' : self.migration_id, 'key' : key, 'bounds' : bounds, 'ts' : datetime.datetime.now() } }
+            checkpoints.update_one({ '_id' : cp_key },u,upsert=True)
+        edges = [None] + bounds + [None]
+        tasks = []
+        for i in range(len(edges) - 1):
+            r = {}
+            if edges[i] is not None:
+                r['$gte'] = edges[i]
+            if edges[i+1] is not None:
+                r['$lt'] = edges[i+1]
+            q = { '$and' : [ query or {}, { key : r } ] } if r else (query or {})
+            tasks.append((self.migration_id,self.func,db_name,coll_name,fn,q,batch_size,'.'.join(filter(None,[name,'range%d' % i])),
+                          self.replication_throttle.max_lag))
+        self.logger.info('parallel_update %s %s ranges on %s workers' % (label,len(tasks),workers))
+        # the logging locks are held for the fork, so the workers don't get one
+        # another thread, like the lease heartbeat, was part way through using
+        handlers = get_logging_handlers()
+        logging._acquireLock()
+        for h in handlers:
+            h.acquire()
+        try:
+            pool = multiprocessing.Pool(min(workers,len(tasks)),init_range_worker,(self.mongodb,))
+        finally:
+            for h in reversed(handlers):
+                h.release()
+            logging._releaseLock()
+        processed = 0
+        try:
+            for attempt in range(retries + 1):
+                failed = []
+                left = len(tasks)
+                for task, count, error, stats in pool.imap_unordered(run_range_update,tasks):
+                    left -= 1
+                    if error:
+                        self.logger.error('parallel_update %s range %s failed: %s' % (label,task[7],error))
+                        failed.append(task)
+                        continue
+                    processed += count
+                    self.replication_throttle.add(stats)
+                    self.logger.info('parallel_update %s range %s done, %s documents, %s ranges left' % (label,task[7],count,left))
+                tasks = failed
+                if not tasks:
+                    break
+                if attempt < retries:
+                    self.logger.info('parallel_update %s retrying %s failed ranges' % (label,len(tasks)))
+        finally:
+            pool.close()
+            pool.join()
+        if tasks:
+            raise Exception('parallel_update %s ranges %s failed, rerun to retry them' % (label,[t[7] for t in tasks]))
+        return processed
+
+    def get_range_bounds(self, db_name, coll_name, key='_id', ranges=16):
+        """Up to ranges - 1 values of key splitting the collection into about equal ranges,
+        from splitVector or, where that isn't allowed like on mongos, a $sample"""
+        import pymongo.errors
+        db = self.mongo[db_name]
+        try:
+            size = db.command('collStats',coll_name).get('size',0)
+            result = db.command('splitVector','%s.%s' % (db_name,coll_name),keyPattern={ key : 1 },
+                                maxChunkSizeBytes=max(1024 * 1024,size / ranges))
+            bounds = [k[key] for k in result['splitKeys']]
+        except pymongo.errors.OperationFailure as exp:
+            self.logger.info('splitVector on %s.%s failed, sampling bounds: %s' % (db_name,coll_name,exp))
+            sample = db[coll_name].aggregate([ { '$sample' : { 'size' : ranges * self.RANGE_SAMPLES } },
+                                               { '$project' : { key : 1 } } ])
+            bounds = sorted([d[key] for d in sample if key in d])[::self.RANGE_SAMPLES][1:]
+        # splitVector can give more than we asked for, keep an even spread
+        if len(bounds) >= ranges:
+            step = len(bounds) / float(ranges)
+            bounds = [bounds[int(i * step)] for i in range(1,ranges)]
+        unique = []
+        for b in bounds:
+            if not unique or b != unique[-1]:
+                unique.append(b)
+        return unique
+
+
+# parallel_update runs these in each worker process, fn and the migration
+# module come with the fork so only the connection needs setting up
+range_mongo = None
+
+def get_logging_handlers():
+    return [h for h in [r() for r in logging._handlerList] if h is not None]
+
+def init_range_worker(mongodb):
+    import pymongo
+    global range_mongo
+    # the parent held the logging locks while forking, start with new ones
+    logging._lock = threading.RLock()
+    for h in get_logging_handlers():
+        h.createLock()
+    range_mongo = pymongo.MongoClient(mongodb)
+
+def run_range_update(task):
+    """batch_update of one range, returns (task, processed, error, throttle stats)"""
+    migration_id, func, db_name, coll_name, fn, query, batch_size, name, max_lag = task
+    logger = logging.getLogger('mongrate')
+    helper = MigrationHelper(range_mongo,migration_id,func,logger,max_lag)
+    key = '.'.join([migration_id,func,db_name,coll_name,name])
+    checkpoints = range_mongo[Mongrate.MONGRATE_DB][Mongrate.MONGRATE_CHECKPOINT_COLL]
+    try:
+        processed = helper.batch_update(db_name,coll_name,fn,query,batch_size,name)
+        checkpoints.update_one({ '_id' : key },{ '$unset' : { 'error' : '' } })
+        return task, processed, None, helper.replication_throttle.get_stats()
+    except Exception as exp:
+        checkpoints.update_one({ '_id' : key },{ '$set' : { 'migration' : migration_id, 'error' : str(exp) } },upsert=True)
+        return task, 0, str(exp), None
+
 
 class Mongrate():
 
@@ -24,13 +442,38 @@ class Mongrate():
     MONGRATE_HISTORY_COLL = 'mongrate.history'
     MONGRATE_WORKING_SCRIPT_COLL = 'mongrate.scripts'
     MONGRATE_HISTORY_SCRIPT_COLL = 'mongrate.history.scripts'
+    MONGRATE_CHECKPOINT_COLL = 'mongrate.checkpoints'
+    MONGRATE_SNAPSHOT_COLL = 'mongrate.snapshots'
+
+    # actions which only need git or the file system
+    OFFLINE_ACTIONS = ('generate_template_migration','plan','bundle')
+    # actions a running 'serve' will answer for other mongrate runs
+    SERVER_ACTIONS = ('status','plan','migrate','verify','history')
+    # args a client can't change, the server keeps it's own connection,
+    # they aren't sent so credentials never go over the socket
+    SERVER_FIXED_ARGS = ('config','user','password','authenticationDatabase','action')
+    # file args a client gives relative to it's own working directory
+    SERVER_PATH_ARGS = ('plan','bundle','fleet')
+    # config which doesn't change what an action does, or is added by Mongrate,
+    # the rest must be the same for the server to run a client's request
+    SERVER_IGNORED_CONFIG = ('logfile','loglevel','verbose','socket','original.mongodb','masked_mongodb')
+    SERVER_PATH_CONFIG = ('git','plan_dir','bundle_dir')
+
+    LOADED_MARKER = '__MONGRATE_LOADED__'
+    LOAD_FAILED_MARKER = '__MONGRATE_LOAD_FAILED__'
+    ESTIMATE_MARKER = '__MONGRATE_ESTIMATE__'
+    # seconds between checks of the COMMIT doc while waiting for the lease
+    LEASE_POLL_MIN = 1
+    LEASE_POLL_MAX = 15
+    # seconds between index build progress messages
+    INDEX_PROGRESS_INTERVAL = 10
 
     def __init__(self, config, args, logger):
         self.config = config
         self.args = args
         self.logger = logger
         # convience to check if --dry-run flag specified
-        if self.args.dry_run:
+        if self.args.dry_run or getattr(self.args,'estimate',False):
             self.DRY_RUN = True
         else:
             self.DRY_RUN = False
@@ -38,7 +481,25 @@ class Mongrate():
         # as needed
         #if not hasattr(self.config['verbose']):
         #    self.config['verbose']=False
-        self.decorate_mongo_connection_string()
+        # resolved refs, ancestry answers and change lists, so we only ask
+        # git once per run, in fleet mode these are shared by all targets
+        self.git_commits = {}
+        self.git_ancestry = {}
+        self.git_changes = {}
+        self.git_lock = threading.RLock()
+        # python migrations by _id, None for javascript ones
+        self.python_migrations = {}
+        # sys.modules names they were imported as, serve drops them after each request
+        self.python_modules = []
+        # mongo shell sessions, one per thread running scripts
+        self.shell_local = threading.local()
+        self.shell_sessions = []
+        self.lock = threading.RLock()
+        # set for the Mongrates of fleet targets, which run on threads
+        self.fleet_target = False
+        # actions which never talk to MongoDB don't need the connection string
+        if not getattr(self.args,'action',None) in self.OFFLINE_ACTIONS:
+            self.decorate_mongo_connection_string()
 
     def act(self,action):
         """Perform the request action"""
@@ -56,6 +517,13 @@ class Mongrate():
     def status(self):
         """Report on the current status of the git repo and MongoDB instance"""
         self.logger.debug("status called")
+        if self.args.json:
+            # only MongoDB is asked unless --with-git
+            status = { 'mongo' : self.__get_mongo_status() }
+            if self.args.with_git:
+                status['git'] = self.__get_git_status()
+            print json.dumps(status,default=str)
+            return True
         git_status = self.__get_git_status()
         print "Current git status\n------------------"
         print git_status
@@ -79,79 +547,853 @@ class Mongrate():
 
     def migrate(self):
         """Migrate to/from the target git commit"""
+        if self.args.fleet:
+            return self.__fleet_run('migrate')
+        if self.args.lease and not self.DRY_RUN:
+            return self.__lease_migrate()
+        return self.__run_migrate()
+
+    def __run_migrate(self):
+        self.__start_run('migrate')
+        ret = None
+        try:
+            ret = self.__migrate()
+            return ret
+        finally:
+            self.__close_pool()
+            self.__close_shell_session()
+            if not self.DRY_RUN and self.run['phases']:
+                # only a run which got through every level without undo applies the target
+                self.__update_target_applied(ret is True and not self.run.get('undo'))
+            self.__finish_run(ret)
+
+    # with --lease many nodes can run the same migrate at once, e.g. app
+    # servers at boot, the first to take the LEASE doc in mongrate.status
+    # runs it and renews the lease every --lease-ttl / 3 seconds, the others
+    # poll the COMMIT doc with backoff until the holder records the target
+    # as applied, then return without doing any git or load work. If the
+    # holder dies it's lease expires and the next node takes over, if it
+    # fails without applying the target the next node tries again.
+    # (change streams can't be opened on the admin database, so no watch)
+    def __lease_migrate(self):
+        """Run the migrate, or wait for the node holding the lease to run it, return True if the target is applied"""
+        mongo_status = self.__get_mongo_status()
+        if mongo_status['status'] == 'NOT MANAGED BY MONGRATE':
+            raise Exception('Cannot migrate: %s' % (mongo_status['status']))
+        if self.args.bundle:
+            target = self.__read_bundle()['target']
+        else:
+            target = self.__resolve_git_commit(self.args.git_commit)
+        owner = '%s:%s:%s' % (socket.gethostname(),os.getpid(),uuid.uuid4().hex[:8])
+        delay = self.LEASE_POLL_MIN
+        waiting = False
+        while True:
+            if self.__is_target_applied(target):
+                self.logger.info('target %s already applied%s' % (target,', done waiting' if waiting else ''))
+                return True
+            if self.__acquire_lease(owner,target):
+                break
+            if not waiting:
+                self.logger.info('another node holds the migrate lease, waiting for %s to be applied' % target)
+                waiting = True
+            time.sleep(delay)
+            delay = min(self.LEASE_POLL_MAX,delay * 2)
+        self.logger.info('took the migrate lease as %s' % owner)
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self.__renew_lease,args=(owner,done))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            # applied by another node between the check and taking the lease
+            if self.__is_target_applied(target):
+                return True
+            return self.__run_migrate()
+        finally:
+            done.set()
+            heartbeat.join()
+            self.__release_lease(owner)
+
+    def __is_target_applied(self,target):
+        mongo = self.__get_mongo_client()
+        commit = mongo[self.MONGRATE_DB][self.MONGRATE_STATUS_COLL].find_one({ '_id' : 'COMMIT' },{ 'applied' : 1 }) or {}
+        applied = commit.get('applied') or {}
+        return applied.get('target') == target and applied.get('distributionCenter') == self.args.distributionCenter
+
+    def __update_target_applied(self,applied):
+        """Record on the COMMIT doc the target this run migrated to, or clear it if the run didn't get there, waiting nodes look for this"""
+        # a failure here must not hide the result of the run, a waiting
+        # node which doesn't see the marker takes the lease and checks again
+        try:
+            mongo = self.__get_mongo_client()
+            if applied and self.run.get('commit'):
+                update = { '$set' : { 'applied' : { 'target' : self.run['commit'],
+                                                    'distributionCenter' : self.args.distributionCenter,
+                                                    'run' : self.run['_id'],
+                                                    'ts' : datetime.datetime.utcnow() } } }
+            else:
+                update = { '$unset' : { 'applied' : '' } }
+            mongo[self.MONGRATE_DB][self.MONGRATE_STATUS_COLL].update_one({ '_id' : 'COMMIT' },update)
+            self.__invalidate_mongo_status()
+        except Exception as exp:
+            self.logger.error('Unable to record the applied target for run %s: %s' % (self.run['_id'],exp))
+
+    def __acquire_lease(self,owner,target):
+        """Take the lease if it's free or expired, return True if we hold it"""
+        import pymongo.errors
+        mongo = self.__get_mongo_client()
+        now = datetime.datetime.utcnow()
+        q = { '_id' : 'LEASE', '$or' : [ { 'expires' : { '$lt' : now } }, { 'owner' : owner } ] }
+        u = { '$set' : { 'owner' : owner, 'target' : target, 'acquired' : now,
+                         'expires' : now + datetime.timedelta(seconds=self.args.lease_ttl) } }
+        try:
+            mongo[self.MONGRATE_DB][self.MONGRATE_STATUS_COLL].update_one(q,u,upsert=True)
+            return True
+        except pymongo.errors.DuplicateKeyError:
+            # the lease doc is there and someone else holds it
+            return False
+
+    def __renew_lease(self,owner,done):
+        """Push the lease expiry out every --lease-ttl / 3 seconds until done is set"""
+        mongo = self.__get_mongo_client()
+        while not done.wait(self.args.lease_ttl / 3.0):
+            expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.args.lease_ttl)
+            try:
+                wr = mongo[self.MONGRATE_DB][self.MONGRATE_STATUS_COLL].update_one({ '_id' : 'LEASE', 'owner' : owner },
+                                                                                    { '$set' : { 'expires' : expires } })
+                if wr.matched_count == 0:
+                    self.logger.error('lost the migrate lease %s, another node may start migrating' % owner)
+            except Exception as exp:
+                self.logger.error('unable to renew the migrate lease: %s' % exp)
+
+    def __release_lease(self,owner):
+        mongo = self.__get_mongo_client()
+        try:
+            mongo[self.MONGRATE_DB][self.MONGRATE_STATUS_COLL].delete_one({ '_id' : 'LEASE', 'owner' : owner })
+            self.logger.info('released the migrate lease %s' % owner)
+        except Exception as exp:
+            self.logger.error('unable to release the migrate lease, it expires in %ss: %s' % (self.args.lease_ttl,exp))
+
+    def __migrate(self):
         mongo_status = self.__get_mongo_status()
         if mongo_status['status'] == 'NOT MANAGED BY MONGRATE':
             raise Exception('Cannot migrate: %s' % (mongo_status['status']))
+        if not self.DRY_RUN:
+            self.__prune_snapshots()
         # get changes from git
-        # load them into mongo
-        self.__clean_stored_migrations()
-        rollback, change_list = self.get_git_changelist()
+        # load them into mongo, scripts already stored with the
+        # same content hash from an earlier run are not loaded again
+        started = time.time()
+        if self.args.bundle:
+            rollback, change_list = self.__get_bundle_changelist()
+            self.run['commit'] = self.bundle_payload['target']
+        else:
+            rollback, change_list = self.get_git_changelist()
+            self.run['commit'] = self.git_commits.get(self.args.git_commit)
+        self.__record_phase('git_changelist',started)
+        self.run['rollback'] = rollback
         self.logger.info('migrate rollback=%s' % (str(rollback)))
+        started = time.time()
         loading_result = True
-        for change in change_list:
-            script = os.path.join(self.config['git'],change['file'])
-            if not self.DRY_RUN:
-                result = self.__load_script(script)
-                loading_result = loading_result and  result
-            else:
+        scripts = [os.path.join(self.config['git'],change['file']) for change in change_list]
+        if self.args.bundle:
+            self.script_hashes = self.__get_bundle_script_hashes()
+        else:
+            self.script_hashes = self.__get_script_hashes(scripts)
+        if self.args.estimate:
+            return self.__estimate(scripts,rollback)
+        to_load = self.__sync_stored_migrations(scripts)
+        js_to_load = [s for s in to_load if not self.__is_python_migration(s)]
+        if not self.DRY_RUN and not self.args.no_batch_load and js_to_load:
+            load_results = self.__load_scripts(js_to_load)
+        else:
+            load_results = {}
+        for script in scripts:
+            if not script in to_load:
+                self.logger.info("%s already loaded with hash %s, skipping" % (script,self.script_hashes[script]))
+                result = True
+            elif self.DRY_RUN:
                 self.logger.info("--dry-run: would have loaded %s" % script)
                 result = True
+            elif script in load_results:
+                result = load_results[script]
+            elif self.__is_python_migration(script):
+                result = self.__load_python_script(script)
+            else:
+                result = self.__load_script(script)
+            loading_result = loading_result and  result
             self.logger.debug("result from %s was %s" % (script, str(result)))
+        self.__record_phase('load',started)
         if not loading_result:
             self.logger.info("Error encountered loading migrations. Please check logs and retry")
             return False
         # figure out run order
-        sorted_scripts = self.__get_scripts_toposort(rollback)
-        self.logger.debug(sorted_scripts)
-        # TODO: if rollback need to run in reverse order!
+        # each level only runs after everything in the level before it, scripts
+        # within a level don't depend on each other so with --jobs > 1 they
+        # run at the same time, with --jobs 1 one after the other
+        started = time.time()
+        if self.args.plan or self.args.bundle:
+            # order already worked out by the plan or bundle action
+            sorted_levels = self.__read_plan([s for s in scripts if os.path.isfile(s)])
+            if rollback:
+                sorted_levels.reverse()
+        else:
+            sorted_levels = self.__get_scripts_toposort_levels(rollback)
+        self.__record_phase('toposort',started)
+        # where each migration came from goes in the history, verify compares it with git
+        mongo = self.__get_mongo_client()
+        for d in mongo[self.MONGRATE_DB][self.MONGRATE_WORKING_SCRIPT_COLL].find({},{ 'mongrateFile' : 1, 'mongrateHash' : 1, 'runAfter' : 1 }):
+            self.run_migrations[d['_id']] = d
+        self.logger.debug(sorted_levels)
+        started = time.time()
         # keep list of scripts we ran, if any errors
         # call rollback in reverse order of how we ran
-        executed_scripts = []
+        executed_levels = []
         undo = False
         running_result = True
-        for script in sorted_scripts:
+        for level in sorted_levels:
             if undo:
                 break
+            if not rollback and not self.__build_level_indexes(level):
+                self.logger.error('Error building indexes for level %s, going into undo mode' % level)
+                undo = True
+                break
+            self.logger.debug("about to run level=%s rollback=%s" % (level,str(rollback)))
+            executed = []
+            for script, result, exp in self.__run_level(level,rollback):
+                if exp is not None:
+                    self.logger.error(exp)
+                    self.logger.error('Error during migration execution, going into undo mode')
+                    undo = True
+                    continue
+                running_result = running_result and result
+                self.logger.debug("result from %s was %s" % (script, str(result)))
+                if not result:
+                    self.logger.error('%s failed, going into undo mode' % script)
+                    undo = True
+                    # it's down() isn't run, it may undo work of an earlier run,
+                    # only what it's snapshot holds is put back
+                    if self.args.snapshot and not rollback:
+                        try:
+                            self.__restore_snapshots(script,self.run['_id'])
+                        except Exception as exp:
+                            self.logger.error('Error restoring the snapshot of %s: %s' % (script,exp))
+                    continue
+                executed.append(script)
+            if executed:
+                executed_levels.append(executed)
+        self.__record_phase('execute',started)
+
+        self.run['undo'] = undo
+        if undo:
+            started = time.time()
+            self.logger.info('starting undo of scripts=%s' % str(executed_levels))
+            ex = executed_levels[:]
+            ex.reverse()
+            for level in ex:
+                self.logger.info('running undo (%s()) for scripts=%s' % ('up' if rollback else 'down', level))
+                for script, result, exp in self.__run_level(level[::-1],not rollback,'undo'):
+                    if exp is not None:
+                        self.logger.error(exp)
+                        self.logger.error('Error during undo of %s' % script)
+                    self.logger.debug("undo result from %s was %s" % (script, str(result)))
+            self.__record_phase('undo',started)
+            self.logger.info('migration failed, executed scripts were undone')
+            return False
+        if not running_result:
+            self.logger.info('migration failed, please check logs')
+            return False
+        #self.logger.info('migrations completed successfully, updating commit to %s' % self.args.git_commit)
+        #self.__update_mongo_mongrate_commit(self.args.git_commit)
+        self.logger.info('migration complete')
+	return True
+
+    # fleet mode, the fleet file lists the targets to migrate or verify:
+    #
+    # targets:
+    #   - name: dc-east
+    #     mongodb: mongodb://east-1:27017,east-2:27017/test?replicaSet=east
+    #     distributionCenter: east
+    #
+    # each target is migrated by it's own Mongrate on a pool of
+    # --fleet-jobs threads, a failing target doesn't affect the others
+    def __fleet_run(self,action):
+        """Run action (migrate or verify) for every target in the fleet file, print a summary and return True if all succeeded"""
+        from multiprocessing.pool import ThreadPool
+        fleet = yaml.safe_load(open(self.args.fleet))
+        targets = fleet.get('targets') or []
+        if not targets:
+            raise Exception('No targets found in fleet file %s' % self.args.fleet)
+        if self.args.bundle:
+            # unpacked once here, the targets share the payload and folder
+            self.__read_bundle()
+        for i in range(len(targets)):
+            if not 'mongodb' in targets[i]:
+                raise Exception('fleet target %s has no mongodb connection string' % i)
+            targets[i].setdefault('name',targets[i].get('distributionCenter') or str(i))
+        jobs = self.args.fleet_jobs or fleet.get('concurrency') or 4
+        self.logger.info('fleet %s of %s targets, %s at a time' % (action,len(targets),jobs))
+        def run(target):
+            started = time.time()
+            summary = { 'name' : target['name'],
+                        'distributionCenter' : target.get('distributionCenter'),
+                        'result' : False, 'run' : None, 'undo' : False, 'error' : None }
+            try:
+                mongrate = self.__get_fleet_target(target)
+                summary['result'] = getattr(mongrate,action)()
+                if hasattr(mongrate,'run'):
+                    summary['run'] = mongrate.run['_id']
+                    summary['undo'] = bool(mongrate.run.get('undo'))
+            except Exception as exp:
+                self.logger.error('fleet target %s failed: %s' % (target['name'],exp))
+                summary['error'] = str(exp)
+            summary['seconds'] = round(time.time() - started,3)
+            return summary
+        pool = ThreadPool(min(jobs,len(targets)))
+        try:
+            summaries = pool.map(run,targets)
+        finally:
+            pool.close()
+            pool.join()
+        row = '%-20s %-20s %-8s %-5s %10s  %-36s %s'
+        print row % ('TARGET','DISTRIBUTIONCENTER','RESULT','UNDO','SECONDS','RUN','ERROR')
+        for s in summaries:
+            print row % (s['name'],s['distributionCenter'] or '','OK' if s['result'] else 'FAILED',
+                         'yes' if s['undo'] else 'no',s['seconds'],s['run'] or '',s['error'] or '')
+        return all([s['result'] for s in summaries])
+
+    def __get_fleet_target(self,target):
+        """A Mongrate for one fleet target, sharing this one's git caches"""
+        config = dict(self.config)
+        for k in ('original.mongodb','masked_mongodb'):
+            config.pop(k,None)
+        config['mongodb'] = target['mongodb']
+        args = copy.copy(self.args)
+        args.fleet = None
+        args.distributionCenter = target.get('distributionCenter')
+        logger = self.logger.getChild(target['name'])
+        mongrate = Mongrate(config,args,logger)
+        mongrate.fleet_target = True
+        if self.args.bundle:
+            mongrate.bundle_payload = self.bundle_payload
+        else:
+            mongrate.repo = self.__get_git_repo()
+        mongrate.git_commits = self.git_commits
+        mongrate.git_ancestry = self.git_ancestry
+        mongrate.git_changes = self.git_changes
+        mongrate.git_lock = self.git_lock
+        mongrate.python_modules = self.python_modules
+        return mongrate
+
+    def __get_jobs(self):
+        jobs = self.args.jobs or 1
+        if jobs < 1:
+            raise Exception('--jobs must be at least 1, got %s' % jobs)
+        return jobs
+
+    def __run_level(self,level,rollback=False,phase='execute'):
+        """Run the up() or down() for all scripts in a level, returns a list of (script, result, exception)"""
+        def run(script):
+            started = time.time()
             try:
                 self.logger.debug("about to run script='%s' rollback=%s" % (script,str(rollback)))
                 if not self.DRY_RUN:
-                    result = self.__run_script(script,rollback)
-                    running_result = running_result and  result
+                    result = self.__run_script(script,rollback,phase == 'undo')
                 else:
                     self.logger.info("--dry-run: would have run %s" % script)
                     result = True
-                self.logger.debug("result from %s was %s" % (script, str(result)))
-                executed_scripts.append(script)
+                self.__record_script(script,rollback,phase,started,result)
+                return script, result, None
             except Exception as exp:
-                self.logger.error(exp)
-                self.logger.error('Error during migration execution, going into undo mode')
-                undo = True
+                self.__record_script(script,rollback,phase,started,False,exp)
+                return script, False, exp
+        if len(level) == 1 or self.__get_jobs() == 1:
+            results = []
+            for script in level:
+                results.append(run(script))
+                # undo carries on, every script which ran gets undone
+                if phase != 'undo' and (results[-1][2] is not None or not results[-1][1]):
+                    break
+            return results
+        # worker threads are kept for the whole run, so each
+        # one keeps it's own mongo shell session between levels
+        if not hasattr(self,'pool'):
+            from multiprocessing.pool import ThreadPool
+            self.logger.debug('starting %s worker threads' % self.__get_jobs())
+            self.pool = ThreadPool(self.__get_jobs())
+        return self.pool.map(run,level)
 
-        if undo:
-            self.logger.info('starting undo of scripts=%s' % str(executed_scripts))
-            # TODO: need to undo in reverse order
-            ex = executed_scripts[:]
-            ex.reverse()
-            for script in ex:
-                self.logger.info('running undo (down()) for script=%s' % script)
-                if not self.DRY_RUN:
-                    result = self.__run_script(script,not rollback)
+    def __close_pool(self):
+        if hasattr(self,'pool'):
+            self.pool.close()
+            self.pool.join()
+            del self.pool
+
+    # migrations can declare the indexes they need next to up and down:
+    #
+    # 'indexes' : [ { 'db' : 'sales', 'collection' : 'orders', 'key' : { 'status' : 1 }, 'unique' : false } ]
+    #
+    # python migrations give key as a list of (field, direction) pairs so the
+    # order is kept, db defaults to the connection string database and
+    # anything else is an index option. Before the up()s of a level run, the
+    # indexes declared by all of it's migrations are built with one
+    # createIndexes per collection, so each collection is only scanned once.
+    # Dropping them on rollback is left to down()
+    def __build_level_indexes(self,level):
+        """Build the indexes declared by the migrations in level, return True if OK, False if Error"""
+        from bson.son import SON
+        from bson.codec_options import CodecOptions
+        # SON keeps the field order of compound keys
+        codec_options = CodecOptions(document_class=SON)
+        mongo = self.__get_mongo_client()
+        stored = mongo[self.MONGRATE_DB].get_collection(self.MONGRATE_WORKING_SCRIPT_COLL,codec_options=codec_options)
+        groups = {}
+        for doc in stored.find({ '_id' : { '$in' : level }, 'indexes' : { '$exists' : True } },{ 'indexes' : 1 }):
+            for spec in doc['indexes']:
+                spec = SON(spec)
+                db_name = spec.pop('db',None) or self.__get_migration_db().name
+                coll_name = spec.pop('collection')
+                key = spec.pop('key')
+                if isinstance(key,list):
+                    key = SON([tuple(k) for k in key])
+                # numbers from javascript are doubles, name them like the shell does
+                name = spec.pop('name',None) or '_'.join(['%s_%s' % (k,int(v) if isinstance(v,float) and v.is_integer() else v)
+                                                          for k,v in key.items()])
+                index = SON([('key',key),('name',name)] + spec.items())
+                group = groups.setdefault((db_name,coll_name),SON())
+                if not name in group:
+                    group[name] = index
+        ok = True
+        for (db_name,coll_name), group in sorted(groups.items()):
+            started = time.time()
+            coll = mongo[db_name].get_collection(coll_name,codec_options=codec_options)
+            existing = list(coll.list_indexes())
+            names = [i['name'] for i in existing]
+            keys = [i['key'].items() for i in existing]
+            indexes = [i for i in group.values() if not i['name'] in names and not i['key'].items() in keys]
+            skipped = [i['name'] for i in group.values() if not i in indexes]
+            if skipped:
+                self.logger.info('indexes %s already exist on %s.%s' % (skipped,db_name,coll_name))
+            build = { 'db' : db_name, 'collection' : coll_name, 'created' : [i['name'] for i in indexes], 'skipped' : skipped }
+            if indexes and self.DRY_RUN:
+                self.logger.info('--dry-run: would have built indexes %s on %s.%s' % (build['created'],db_name,coll_name))
+            elif indexes:
+                self.logger.info('building indexes %s on %s.%s' % (build['created'],db_name,coll_name))
+                done = threading.Event()
+                watcher = threading.Thread(target=self.__watch_index_build,args=(db_name,coll_name,done))
+                watcher.daemon = True
+                watcher.start()
+                try:
+                    mongo[db_name].command('createIndexes',coll_name,indexes=indexes)
+                    self.logger.info('built indexes %s on %s.%s' % (build['created'],db_name,coll_name))
+                except Exception as exp:
+                    self.logger.error('Error building indexes on %s.%s: %s' % (db_name,coll_name,exp))
+                    build['error'] = str(exp)
+                    ok = False
+                finally:
+                    done.set()
+                    watcher.join()
+            build['seconds'] = round(time.time() - started,3)
+            self.run.setdefault('indexes',[]).append(build)
+            if not ok:
+                break
+        return ok
+
+    def __watch_index_build(self,db_name,coll_name,done):
+        """Log the progress currentOp reports for index builds on db.coll until done is set"""
+        mongo = self.__get_mongo_client()
+        ns = '%s.%s' % (db_name,coll_name)
+        q = { 'ns' : ns, '$or' : [ { 'command.createIndexes' : { '$exists' : True } }, { 'msg' : { '$regex' : '^Index Build' } } ] }
+        while not done.wait(self.INDEX_PROGRESS_INTERVAL):
+            try:
+                ops = mongo['admin'].command('currentOp',q).get('inprog',[])
+            except Exception as exp:
+                self.logger.debug('currentOp failed: %s' % exp)
+                continue
+            for op in ops:
+                progress = op.get('progress') or {}
+                if progress.get('total'):
+                    self.logger.info('index build on %s: %s %s/%s (%.1f%%)' % (ns,op.get('msg',''),progress.get('done'),
+                                     progress['total'],100.0 * progress.get('done',0) / progress['total']))
                 else:
-                    self.logger.info("--dry-run: would have run %s" % script)
-                    result = True
-                self.logger.debug("undo result from %s was %s" % (script, str(result)))
+                    self.logger.info('index build on %s: %s running for %ss' % (ns,op.get('msg',''),op.get('secs_running')))
+
+    # timings for a run, written to the history collections
+    # when the run finishes and printed with --profile
+    def __start_run(self,action):
+        self.run = { '_id' : str(uuid.uuid4()),
+                     'action' : action,
+                     'target' : self.args.git_commit,
+                     'distributionCenter' : self.args.distributionCenter,
+                     'dryRun' : self.DRY_RUN,
+                     'jobs' : self.args.jobs,
+                     'start' : datetime.datetime.utcnow(),
+                     'phases' : {} }
+        self.run_started = time.time()
+        self.run_scripts = []
+        self.run_throttle = {}
+        self.run_migrations = {}
+        self.logger.info('starting run %s' % self.run['_id'])
+
+    def __record_phase(self,phase,started):
+        self.run['phases'][phase] = round(time.time() - started,3)
+        self.logger.debug('phase %s took %ss' % (phase,self.run['phases'][phase]))
+
+    def __record_script(self,script,rollback,phase,started,result,exp=None):
+        doc = { 'run' : self.run['_id'],
+                'script' : script,
+                'func' : 'down' if rollback else 'up',
+                'phase' : phase,
+                'start' : datetime.datetime.utcfromtimestamp(started),
+                'seconds' : round(time.time() - started,3),
+                'result' : result }
+        if exp is not None:
+            doc['error'] = str(exp)
+        if script in self.run_migrations:
+            m = self.run_migrations[script]
+            # migrations stored by older versions have no mongrateFile
+            f = m.get('mongrateFile')
+            doc['file'] = os.path.relpath(f,self.config['git']) if f else None
+            doc['hash'] = m.get('mongrateHash')
+            doc['runAfter'] = m.get('runAfter',[])
+        with self.lock:
+            # replication lag seen by python migrations, totalled for the run
+            throttle = self.run_throttle.pop(script,None)
+            if throttle and throttle['documents']:
+                doc['throttle'] = throttle
+                total = self.run.setdefault('throttle',{ 'maxLag' : 0, 'pauses' : 0, 'pausedSeconds' : 0, 'slowedSeconds' : 0, 'documents' : 0 })
+                total['maxLag'] = max(total['maxLag'],throttle['maxLag'])
+                for k in ('pauses','pausedSeconds','slowedSeconds','documents'):
+                    total[k] += throttle[k]
+            self.run_scripts.append(doc)
+
+    def __finish_run(self,ret):
+        self.run['end'] = datetime.datetime.utcnow()
+        self.run['seconds'] = round(time.time() - self.run_started,3)
+        self.run['result'] = ret
+        if self.args.profile:
+            profile = dict(self.run)
+            profile['scripts'] = self.run_scripts
+            print json.dumps(profile,indent=2,default=str)
+        if not self.run['phases']:
+            # stopped before doing anything, e.g. instance not managed by mongrate
+            self.logger.debug('nothing to record for run %s' % self.run['_id'])
+            return
+        if self.DRY_RUN:
+            self.logger.info('--dry-run: would have saved history for run %s' % self.run['_id'])
+            return
+        # history is for reporting, a failure to save it should not fail the run
+        try:
+            mongo = self.__get_mongo_client()
+            self.__ensure_history_indexes()
+            wr = mongo[self.MONGRATE_DB][self.MONGRATE_HISTORY_COLL].insert_one(self.run)
+            self.logger.debug('inserted history %s writeResult=%s' % (self.run['_id'],str(wr)))
+            if self.run_scripts:
+                wr = mongo[self.MONGRATE_DB][self.MONGRATE_HISTORY_SCRIPT_COLL].insert_many(self.run_scripts)
+                self.logger.debug('inserted %s history scripts writeResult=%s' % (len(self.run_scripts),str(wr)))
+            self.__prune_history()
+        except Exception as exp:
+            self.logger.error('Unable to save history for run %s: %s' % (self.run['_id'],exp))
+
+    # history retention is set in the config file, either or both of
+    #
+    # history_retention_days: 365    TTL indexes on start drop older runs
+    # history_retention_runs: 1000   runs past the newest 1000 are removed by migrate
+    #
+    # status_retention_days (default 90) is the TTL of the msg documents
+    # in mongrate.status, INITIALIZE and COMMIT are kept
+    #
+    # times in history and status are UTC, as the TTL indexes expect
+    def __ensure_history_indexes(self):
+        """Create the history and status indexes which are missing, they are needed for the history action's range queries"""
+        import pymongo
+        mongo = self.__get_mongo_client()
+        history = mongo[self.MONGRATE_DB][self.MONGRATE_HISTORY_COLL]
+        scripts = mongo[self.MONGRATE_DB][self.MONGRATE_HISTORY_SCRIPT_COLL]
+        status = mongo[self.MONGRATE_DB][self.MONGRATE_STATUS_COLL]
+        # one listIndexes per collection, every run checks them
+        existing = dict([(coll.name,coll.index_information()) for coll in (history,scripts,status)])
+        # run id is the _id of history
+        self.__ensure_index(history,[('commit',pymongo.ASCENDING),('start',pymongo.DESCENDING)],existing)
+        self.__ensure_index(scripts,[('run',pymongo.ASCENDING),('start',pymongo.ASCENDING)],existing)
+        self.__ensure_index(scripts,[('script',pymongo.ASCENDING),('start',pymongo.DESCENDING)],existing)
+        days = self.config.get('history_retention_days')
+        for coll in (history,scripts):
+            self.__ensure_ttl_index(coll,'start',days,existing,name='start_ttl')
+            if not days:
+                self.__ensure_index(coll,[('start',pymongo.DESCENDING)],existing)
+        self.__ensure_ttl_index(status,'ts',self.config.get('status_retention_days',90),existing,name='msg_ttl',
+                                partialFilterExpression={ 'msg' : { '$exists' : True } })
+
+    def __ensure_index(self,coll,keys,existing,**kwargs):
+        """Create an index on coll unless existing, index_information by collection name, has one of the same name"""
+        # the name create_index would give it
+        name = kwargs.setdefault('name','_'.join(['%s_%s' % key for key in keys]))
+        if not name in existing[coll.name]:
+            coll.create_index(keys,**kwargs)
+
+    def __ensure_ttl_index(self,coll,field,days,existing,**kwargs):
+        """A TTL index on field expiring documents after days, dropped if days is not set"""
+        import pymongo
+        name = kwargs['name']
+        index = existing[coll.name].get(name)
+        if not days:
+            if index:
+                self.logger.info('retention removed, dropping TTL index %s on %s' % (name,coll.name))
+                coll.drop_index(name)
+            return
+        seconds = int(days * 24 * 60 * 60)
+        if not index:
+            coll.create_index([(field,pymongo.ASCENDING)],expireAfterSeconds=seconds,**kwargs)
+        elif index.get('expireAfterSeconds') != seconds:
+            self.logger.info('changing TTL of %s on %s to %s days' % (name,coll.name,days))
+            coll.database.command('collMod',coll.name,index={ 'name' : name, 'expireAfterSeconds' : seconds })
+
+    def __prune_history(self):
+        """Remove runs past the newest history_retention_runs, with their scripts"""
+        import pymongo
+        keep = self.config.get('history_retention_runs')
+        if not keep:
+            return
+        mongo = self.__get_mongo_client()
+        history = mongo[self.MONGRATE_DB][self.MONGRATE_HISTORY_COLL]
+        oldest = list(history.find({},{ 'start' : 1 }).sort('start',pymongo.DESCENDING).skip(keep - 1).limit(1))
+        if not oldest:
+            return
+        q = { 'start' : { '$lt' : oldest[0]['start'] } }
+        wr = history.delete_many(q)
+        if wr.deleted_count:
+            wr = mongo[self.MONGRATE_DB][self.MONGRATE_HISTORY_SCRIPT_COLL].delete_many(q)
+            self.logger.info('removed runs before %s from the history, keeping %s' % (oldest[0]['start'],keep))
+
+    # history pages through runs newest first with range queries on start,
+    # each page ends with the --before to use for the next one:
+    #
+    #   history                         runs
+    #   history --git-commit <ref>      runs for a commit
+    #   history --migration-id <_id>    up()/down() of one migration
+    #   history --run <run id>          one run and it's scripts
+    def history(self):
+        """Print a page of the run history, newest first"""
+        import pymongo
+        mongo = self.__get_mongo_client()
+        history = mongo[self.MONGRATE_DB][self.MONGRATE_HISTORY_COLL]
+        scripts = mongo[self.MONGRATE_DB][self.MONGRATE_HISTORY_SCRIPT_COLL]
+        if self.args.run:
+            run = history.find_one({ '_id' : self.args.run })
+            if not run:
+                raise Exception('run %s not found in the history' % self.args.run)
+            run['scripts'] = list(scripts.find({ 'run' : self.args.run }).sort('start',pymongo.ASCENDING))
+            if self.args.json:
+                print json.dumps(run,default=str)
+                return True
+            row = '%-30s %-5s %-8s %-7s %10s  %s'
+            print 'run %s %s %s %s UTC result=%s seconds=%s' % (run['_id'],run['action'],run.get('commit') or run.get('target'),
+                                                             run['start'],run.get('result'),run.get('seconds'))
+            print row % ('MIGRATION','FUNC','PHASE','RESULT','SECONDS','ERROR')
+            for d in run['scripts']:
+                print row % (d['script'],d['func'],d['phase'],d['result'],d['seconds'],d.get('error',''))
+            return True
+        q = {}
+        if self.args.before:
+            q['start'] = { '$lt' : self.__parse_history_time(self.args.before) }
+        if self.args.migration_id:
+            q['script'] = self.args.migration_id
+            page = list(scripts.find(q).sort('start',pymongo.DESCENDING).limit(self.args.limit))
+            row = '%-26s %-36s %-5s %-8s %-7s %10s  %s'
+            header = ('START (UTC)','RUN','FUNC','PHASE','RESULT','SECONDS','ERROR')
+            fields = lambda d: (d['start'],d['run'],d['func'],d['phase'],d['result'],d['seconds'],d.get('error',''))
         else:
-            #self.logger.info('migrations completed successfully, updating commit to %s' % self.args.git_commit)
-            #self.__update_mongo_mongrate_commit(self.args.git_commit)
-            self.logger.info('migration complete')
-	return True
+            if self.args.git_commit:
+                try:
+                    q['commit'] = self.__resolve_git_commit(self.args.git_commit)
+                except Exception:
+                    q['commit'] = self.args.git_commit
+            page = list(history.find(q).sort('start',pymongo.DESCENDING).limit(self.args.limit))
+            row = '%-26s %-36s %-8s %-40s %-7s %10s'
+            header = ('START (UTC)','RUN','ACTION','COMMIT','RESULT','SECONDS')
+            fields = lambda d: (d['start'],d['_id'],d['action'],d.get('commit') or d.get('target') or '',d.get('result'),d.get('seconds'))
+        if self.args.json:
+            print json.dumps(page,default=str)
+            return True
+        print row % header
+        for d in page:
+            print row % fields(d)
+        if len(page) == self.args.limit:
+            print 'next page: --before %s' % page[-1]['start'].isoformat()
+        return True
+
+    def __parse_history_time(self,value):
+        """A --before time, in UTC like the history"""
+        for f in ('%Y-%m-%dT%H:%M:%S.%f','%Y-%m-%dT%H:%M:%S','%Y-%m-%d'):
+            try:
+                return datetime.datetime.strptime(value,f)
+            except ValueError:
+                pass
+        raise Exception('--before %s is not a time like 2017-01-31T12:00:00' % value)
+
+    # --estimate reports how heavy the migrations of a run are without loading
+    # or running them, each migration declares what it touches in it's
+    # exports (module level in python migrations):
+    #
+    # 'touches' : [ { 'db' : 'sales', 'collection' : 'orders', 'filter' : { 'status' : 'open' } } ]
+    #
+    # db defaults to the connection string database and filter to all
+    # documents, javascript filters are read as extended JSON so use
+    # { '$date' : ... } or { '$oid' : ... } for dates and ObjectIds
+    def __estimate(self,scripts,rollback):
+        """Print the documents and bytes each migration and level would touch, returns True if all could be estimated"""
+        started = time.time()
+        scripts = [s for s in scripts if os.path.isfile(s)]
+        metas = self.__get_estimate_metadata(scripts)
+        ok = len(metas) == len(scripts)
+        if self.args.plan or self.args.bundle:
+            levels = self.__read_plan(scripts)
+        else:
+            from toposort import toposort
+            dt = dict([(m['_id'],set(m['runAfter'])) for m in metas.values()])
+            levels = [ sorted(level) for level in toposort(dt) ]
+        # runAfter of migrations which aren't in this run aren't estimated
+        by_id = dict([(m['_id'],m) for m in metas.values()])
+        levels = [ [x for x in level if x in by_id] for level in levels ]
+        levels = [ level for level in levels if level ]
+        if rollback:
+            levels.reverse()
+        estimate = { 'levels' : [], 'documents' : 0, 'bytes' : 0 }
+        for i in range(len(levels)):
+            level = { 'level' : i + 1, 'scripts' : [], 'documents' : 0, 'bytes' : 0 }
+            for _id in levels[i]:
+                script = { '_id' : _id, 'file' : by_id[_id]['file'], 'touches' : [], 'documents' : 0, 'bytes' : 0 }
+                for touch in by_id[_id]['touches']:
+                    try:
+                        touch = self.__estimate_touch(touch)
+                    except Exception as exp:
+                        self.logger.error('Unable to estimate %s for %s: %s' % (touch,_id,exp))
+                        touch = { 'declared' : touch, 'error' : str(exp) }
+                        ok = False
+                    script['touches'].append(touch)
+                    script['documents'] += touch.get('documents',0)
+                    script['bytes'] += touch.get('bytes',0)
+                if not script['touches']:
+                    self.logger.info('%s does not declare the collections it touches' % _id)
+                level['scripts'].append(script)
+                level['documents'] += script['documents']
+                level['bytes'] += script['bytes']
+            estimate['levels'].append(level)
+            estimate['documents'] += level['documents']
+            estimate['bytes'] += level['bytes']
+        self.run['estimate'] = estimate
+        self.__record_phase('estimate',started)
+        if self.args.json:
+            print json.dumps(estimate,default=str)
+            return ok
+        row = '%-6s %-30s %-40s %12s %14s  %s'
+        print row % ('LEVEL','MIGRATION','NAMESPACE','DOCUMENTS','BYTES','PLAN')
+        for level in estimate['levels']:
+            for script in level['scripts']:
+                if not script['touches']:
+                    print row % (level['level'],script['_id'],'(not declared)','','','')
+                for touch in script['touches']:
+                    if 'error' in touch:
+                        print row % (level['level'],script['_id'],touch['declared'],'','',touch['error'])
+                        continue
+                    print row % (level['level'],script['_id'],'%s.%s' % (touch['db'],touch['collection']),
+                                 touch['documents'],touch['bytes'],touch['plan'])
+            print row % (level['level'],'(level total)','',level['documents'],level['bytes'],'')
+        print row % ('','(total)','',estimate['documents'],estimate['bytes'],'')
+        return ok
+
+    def __get_estimate_metadata(self,scripts):
+        """Returns script -> { 'file', '_id', 'runAfter', 'touches' }, read without calling onLoad"""
+        metas = {}
+        js = []
+        for script in scripts:
+            if not self.__is_python_migration(script):
+                js.append(script)
+                continue
+            try:
+                migration = self.__import_python_migration(script)
+                metas[script] = { 'file' : script,
+                                  '_id' : str(migration._id),
+                                  'runAfter' : [str(x) for x in getattr(migration,'runAfter',[])],
+                                  'touches' : list(getattr(migration,'touches',[])) }
+            except Exception as exp:
+                self.logger.error("Error reading script '%s' error: '%s'" % (script, exp))
+        if not js:
+            return metas
+        from bson import json_util
+        lines = []
+        lines.append("mongrate = {};")
+        lines.append("%s.forEach(function(f) {" % json.dumps(js))
+        lines.append("    try {")
+        lines.append("        delete mongrate.exports;")
+        lines.append("        load(f);")
+        lines.append("        var m = mongrate.exports;")
+        lines.append("        print('%s ' + JSON.stringify({ 'file' : f, '_id' : m._id, 'runAfter' : m.runAfter || [], 'touches' : m.touches || [] }));" % self.ESTIMATE_MARKER)
+        lines.append("    } catch(error) {")
+        lines.append("        print('Error reading ' + f + ': ' + error);")
+        lines.append("    }")
+        lines.append("});")
+        def on_line(line):
+            line = line.strip()
+            if line.startswith(self.ESTIMATE_MARKER + ' '):
+                meta = json_util.loads(line[len(self.ESTIMATE_MARKER) + 1:])
+                meta['_id'] = str(meta['_id'])
+                meta['runAfter'] = [str(x) for x in meta['runAfter']]
+                metas[str(meta['file'])] = meta
+        ok, output = self.__eval_shell_output('read touches','\n'.join(lines),on_line)
+        for script in js:
+            if not script in metas:
+                self.logger.error("Error reading script '%s' output:'%s'" % (script, output))
+        return metas
+
+    def __estimate_touch(self,touch):
+        """Count, size and explain the documents matching one declared filter"""
+        import pymongo.errors
+        mongo = self.__get_mongo_client()
+        db_name = touch.get('db') or self.__get_migration_db().name
+        query = touch.get('filter') or {}
+        db = mongo[db_name]
+        try:
+            stats = db.command('collStats',touch['collection'])
+        except pymongo.errors.OperationFailure:
+            # collection doesn't exist (yet)
+            stats = {}
+        if query:
+            documents = db[touch['collection']].count_documents(query)
+        else:
+            documents = stats.get('count',0)
+        explain = db.command('explain',{ 'find' : touch['collection'], 'filter' : query },verbosity='queryPlanner')
+        return { 'db' : db_name,
+                 'collection' : touch['collection'],
+                 'filter' : query,
+                 'documents' : documents,
+                 'bytes' : int(documents * stats.get('avgObjSize',0)),
+                 'collectionDocuments' : stats.get('count',0),
+                 'collectionBytes' : stats.get('size',0),
+                 'plan' : self.__get_plan_summary(explain['queryPlanner']['winningPlan']) }
+
+    def __get_plan_summary(self,plan):
+        """The stages of a winning plan, e.g. 'FETCH <- IXSCAN status_1'"""
+        plan = plan.get('queryPlan',plan)
+        stages = []
+        while plan:
+            stage = plan.get('stage','?')
+            if 'indexName' in plan:
+                stage += ' ' + plan['indexName']
+            stages.append(stage)
+            plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+        return ' <- '.join(stages)
 
     def generate_template_migration(self):
         """Generate a template migration"""
         self.logger.info('generating template migration')
         mig_id = self.args.migration_id
         self.logger.info('template migration name = %s' % mig_id)
-        fname = self.args.migration_id + '.js'
+        python = self.args.template_format == 'python'
+        if python:
+            fname = self.args.migration_id + '.py'
+        else:
+            fname = self.args.migration_id + '.js'
 	# TODO: generate does NOT support distibution center 
 	# specific scripts - just generates in the 'common' folder
 	script_common_dir = os.path.join(self.config['migration_home'],self.config['migration_common_home'])
@@ -159,12 +1401,51 @@ class Mongrate():
         self.logger.debug('script_filename=%s', script_filename)
         if os.path.isfile(script_filename):
             self.logger.error('detected %s already exists' % script_filename)
-            script_filename = script_filename + '.' + str(uuid.uuid4())
+            if python:
+                # keep the .py so it's still picked up as a python migration
+                base, ext = os.path.splitext(script_filename)
+                script_filename = base + '_' + str(uuid.uuid4()).replace('-','') + ext
+            else:
+                script_filename = script_filename + '.' + str(uuid.uuid4())
             self.logger.info('updated script filename to %s' % script_filename)
         t = open(script_filename,"w")
         def write_line(fd,s):
             fd.write(s)
             fd.write('\n')
+        if python:
+            write_line(t,'#')
+            write_line(t,'# MongoDB Migration')
+            write_line(t,'#')
+            write_line(t,'# Generated on '+str(datetime.datetime.now()))
+            write_line(t,'# _id : ' + mig_id)
+            write_line(t,'#')
+            write_line(t,'')
+            write_line(t,'_id = \'' + mig_id + '\'')
+            write_line(t,'runAfter = []')
+            write_line(t,'# collections up/down change, reported by migrate --estimate and copied by --snapshot')
+            write_line(t,'# e.g. [ { \'db\' : \'test\', \'collection\' : \'orders\', \'filter\' : { \'status\' : \'open\' } } ]')
+            write_line(t,'touches = []')
+            write_line(t,'# indexes built before up() runs, with one createIndexes per collection for all migrations in a level')
+            write_line(t,'# e.g. [ { \'db\' : \'test\', \'collection\' : \'orders\', \'key\' : [ (\'status\', 1) ] } ]')
+            write_line(t,'indexes = []')
+            write_line(t,'')
+            write_line(t,'def onLoad(db):')
+            write_line(t,'    # TODO: Add onLoad logic here')
+            write_line(t,'    pass')
+            write_line(t,'')
+            write_line(t,'def up(db):')
+            write_line(t,'    # TODO: rollforward logic')
+            write_line(t,'    # TODO: db is the connection string database, use db.client[name] for others')
+            write_line(t,'    pass')
+            write_line(t,'')
+            write_line(t,'def down(db):')
+            write_line(t,'    # TODO: Add undo/rollback logic here')
+            write_line(t,'    # TODO: db is the connection string database, use db.client[name] for others')
+            write_line(t,'    pass')
+            t.close()
+            self.logger.info('Template migration %s generated %s' % (mig_id, script_filename))
+            self.logger.info('migration generation complete')
+            return True
         write_line(t,'/*************************')
         write_line(t,'* MongoDB Migration')
         write_line(t,'*')
@@ -175,6 +1456,12 @@ class Mongrate():
         write_line(t,'migration = {')
         write_line(t,'  \'_id\' : \'' + mig_id + '\',')
         write_line(t,'  \'runAfter\' : [],')
+        write_line(t,'  // collections up/down change, reported by migrate --estimate and copied by --snapshot')
+        write_line(t,'  // e.g. [ { \'db\' : \'test\', \'collection\' : \'orders\', \'filter\' : { \'status\' : \'open\' } } ]')
+        write_line(t,'  \'touches\' : [],')
+        write_line(t,'  // indexes built before up() runs, with one createIndexes per collection for all migrations in a level')
+        write_line(t,'  // e.g. [ { \'db\' : \'test\', \'collection\' : \'orders\', \'key\' : { \'status\' : 1 } } ]')
+        write_line(t,'  \'indexes\' : [],')
         write_line(t,'  \'onLoad\' : function() {')
         write_line(t,'      // TODO: Add onLoad logic here')
         write_line(t,'      },')
@@ -199,131 +1486,423 @@ class Mongrate():
 	return True
 
 
+    # verify compares what the history says is applied with the migration
+    # tree at --git-commit (default HEAD). The blob shas come straight from
+    # git ls-tree so nothing is read or hashed, and the applied state is one
+    # aggregation over the history, so it's cheap enough to run often:
+    #
+    #   added        in the tree but not applied
+    #   changed      applied from a different version of the file
+    #   missing      applied but no longer in the tree
+    #   out-of-order applied before (or without) a migration in it's runAfter
+    #
+    # files already in the tree at the mongrate COMMIT count as applied
+    def verify(self):
+        """Report drift between the applied migrations and the migration tree at the target git commit, return True if there is none"""
+        if self.args.fleet:
+            return self.__fleet_run('verify')
+        started = time.time()
+        mongo_status = self.__get_mongo_status()
+        if mongo_status['status'] == 'NOT MANAGED BY MONGRATE':
+            raise Exception('Cannot verify: %s' % (mongo_status['status']))
+        commit = self.__resolve_git_commit(self.args.git_commit or 'HEAD')
+        filters = self.__get_migration_filters()
+        tree = self.__get_git_tree(commit,filters)
+        baseline = {}
+        mongrate_commit = [x for x in mongo_status['status'] if x['_id']=='COMMIT'][0]['value']
+        if mongrate_commit:
+            try:
+                baseline = self.__get_git_tree(self.__resolve_git_commit(mongrate_commit),filters)
+            except Exception as exp:
+                self.logger.info('not using the mongrate commit as a baseline: %s' % exp)
+        applied = {}
+        by_file = {}
+        for m in self.__get_applied_migrations():
+            if m['func'] == 'up':
+                applied[m['_id']] = m
+            if m.get('file'):
+                by_file[m['file']] = m
+        drift = []
+        for path, blob in sorted(tree.items()):
+            m = by_file.get(path)
+            if m is None or not m['_id'] in applied:
+                if baseline.get(path) != blob:
+                    drift.append(('added',m['_id'] if m else '',path,'not applied'))
+            elif m.get('hash') != blob:
+                drift.append(('changed',m['_id'],path,'applied %s, repo has %s' % (m.get('hash'),blob)))
+        for path, m in sorted(by_file.items()):
+            if m['_id'] in applied and not path in tree:
+                drift.append(('missing',m['_id'],path,'applied %s, not in the tree' % m['start']))
+        for _id, m in sorted(applied.items()):
+            for dep in m.get('runAfter') or []:
+                if not dep in applied:
+                    drift.append(('out-of-order',_id,m.get('file') or '','runAfter %s is not applied' % dep))
+                elif applied[dep]['start'] > m['start']:
+                    drift.append(('out-of-order',_id,m.get('file') or '','runAfter %s was applied after it' % dep))
+        seconds = round(time.time() - started,3)
+        if self.args.json:
+            print json.dumps({ 'commit' : commit, 'filters' : filters, 'migrations' : len(tree), 'applied' : len(applied),
+                               'seconds' : seconds, 'drift' : [ dict(zip(('state','_id','file','detail'),d)) for d in drift ] },default=str)
+            return not drift
+        lines = ['verify %s at %s: %s migrations in the tree, %s applied, %s differences in %ss' %
+                 (self.config.get('masked_mongodb',''),commit,len(tree),len(applied),len(drift),seconds)]
+        row = '%-13s %-30s %-50s %s'
+        if drift:
+            lines.append(row % ('STATE','MIGRATION','FILE','DETAIL'))
+        for d in drift:
+            lines.append(row % d)
+        # in one go so fleet targets don't interleave
+        print '\n'.join(lines)
+        return not drift
+
+    def __get_git_tree(self,commit,filters):
+        """Returns path -> blob sha of the migrations under the filters folders at commit"""
+        tree = {}
+        for entry, path in self.__iter_git_name_status(["ls-tree","-r","--full-tree",commit],filters):
+            mode, kind, blob = entry.split(' ')
+            if kind == 'blob':
+                tree[path] = blob
+        return tree
+
+    def __get_applied_migrations(self):
+        """The last successful up() or down() of each migration in the history, with the file, hash and runAfter it ran with"""
+        mongo = self.__get_mongo_client()
+        pipeline = [ { '$match' : { 'result' : True, 'phase' : { '$in' : [ 'execute', 'undo' ] } } },
+                     { '$sort' : { 'start' : 1 } },
+                     { '$group' : { '_id' : '$script',
+                                    'func' : { '$last' : '$func' },
+                                    'start' : { '$last' : '$start' },
+                                    'file' : { '$last' : '$file' },
+                                    'hash' : { '$last' : '$hash' },
+                                    'runAfter' : { '$last' : '$runAfter' } } } ]
+        return list(mongo[self.MONGRATE_DB][self.MONGRATE_HISTORY_SCRIPT_COLL].aggregate(pipeline,allowDiskUse=True))
+
+    def plan(self):
+        """Compute and validate the run order for the target git commit without MongoDB and write it to a plan file"""
+        if not self.args.git_commit:
+            raise Exception("--git-commit is required to plan")
+        target_commit, current_commit = self.__get_git_target()
+        filters = self.__get_migration_filters()
+        change_list = self.__get_git_changes(target_commit,current_commit,filters)
+        plan = self.__compile_migrations(target_commit,filters,change_list)
+        if plan['errors']:
+            for error in plan['errors']:
+                self.logger.error(error)
+            self.logger.info('plan has %s errors, no plan file written' % len(plan['errors']))
+            return False
+        plan_file = self.args.plan or self.__get_plan_filename(target_commit)
+        f = open(plan_file,'w')
+        json.dump(plan,f,separators=(',',':'))
+        f.close()
+        for i in range(len(plan['levels'])):
+            print 'level %s: %s' % (i,', '.join(plan['levels'][i]))
+        self.logger.info('plan for %s written to %s' % (target_commit,plan_file))
+        return True
+
+    def bundle(self):
+        """Pack the migrations for the target git commit into a checksummed file which migrate --bundle runs without git"""
+        if not self.args.git_commit:
+            raise Exception("--git-commit is required to bundle")
+        target_commit, current_commit = self.__get_git_target()
+        filters = self.__get_migration_filters()
+        change_list = self.__get_git_changes(target_commit,current_commit,filters)
+        contents = {}
+        plan = self.__compile_migrations(target_commit,filters,change_list,contents)
+        if plan['errors']:
+            for error in plan['errors']:
+                self.logger.error(error)
+            self.logger.info('plan has %s errors, no bundle written' % len(plan['errors']))
+            return False
+        repo = self.__get_git_repo()
+        newer = repo.git.rev_list('%s..%s' % (target_commit,current_commit)).split()
+        payload = { 'target' : target_commit,
+                    'head' : current_commit,
+                    'newer' : newer,
+                    'filters' : filters,
+                    'changes' : change_list,
+                    'plan' : plan,
+                    'files' : dict([(path,content.decode('utf-8')) for path, content in contents.items()]) }
+        checksum = self.__get_bundle_checksum(payload)
+        bundle_file = self.args.bundle or 'mongrate-bundle-%s.json.gz' % target_commit
+        f = gzip.open(bundle_file,'wb')
+        f.write(json.dumps({ 'checksum' : checksum, 'payload' : payload },separators=(',',':')))
+        f.close()
+        self.logger.info('bundle of %s migrations for %s written to %s checksum=%s' % (len(contents),target_commit,bundle_file,checksum))
+        return True
+
+    # serve keeps this Mongrate, with it's repo, MongoDB client and
+    # commit ancestry cache, for the requests of other mongrate runs.
+    # A request is one line of json { 'action' : ..., 'args' : {...} }
+    # and the reply is json { 'ret' : ..., 'output' : ... } with
+    # everything the action printed or logged
+    def serve(self):
+        """Keep git and MongoDB connections warm and run status, plan and migrate for clients on a unix socket"""
+        path = get_server_socket(self.config)
+        if os.path.exists(path):
+            if forward_to_server(path,None,self.logger) is not None:
+                raise Exception('mongrate is already serving on %s' % path)
+            os.remove(path)
+        self.server_args = self.args
+        self.server_config = dict(self.config)
+        self.server_identity = get_server_identity(self.config)
+        self.__get_mongo_client()
+        if 'git' in self.config:
+            self.__get_git_repo()
+        server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        server.bind(path)
+        os.chmod(path,0600)
+        server.listen(5)
+        self.logger.info('serving on %s' % path)
+        try:
+            while True:
+                conn, addr = server.accept()
+                f = conn.makefile('rw')
+                try:
+                    request = json.loads(f.readline() or 'null')
+                    if request is not None:
+                        reply = self.__handle_request(request)
+                        f.write(json.dumps(reply,default=str))
+                except Exception as exp:
+                    self.logger.error('error handling request: %s' % exp)
+                finally:
+                    f.close()
+                    conn.close()
+        except KeyboardInterrupt:
+            self.logger.info('stopping server')
+        finally:
+            server.close()
+            os.remove(path)
+        return True
+
+    def __handle_request(self,request):
+        """Run one client request with this Mongrate, returns the reply"""
+        action = request.get('action')
+        if not action in self.SERVER_ACTIONS:
+            return { 'ret' : False, 'output' : 'action %s is not served, run it directly\n' % action }
+        # the socket is shared by every config file which doesn't set one
+        identity = request.get('config') or {}
+        if identity != self.server_identity:
+            differ = sorted(set([k for k in set(identity) | set(self.server_identity) if identity.get(k) != self.server_identity.get(k)]))
+            self.logger.info('refused request, config differs in %s' % ', '.join(differ))
+            return { 'ret' : False, 'output' : 'mongrate serve on %s was started with a different config, %s differ, '
+                     'run with --no-server or set socket in the config file\n' % (get_server_socket(self.server_config),', '.join(differ)) }
+        self.logger.info('request for action %s' % action)
+        args = copy.copy(self.server_args)
+        for k, v in (request.get('args') or {}).items():
+            if not k in self.SERVER_FIXED_ARGS:
+                setattr(args,k,v)
+        self.args = args
+        self.DRY_RUN = bool(args.dry_run or args.estimate)
+        self.config = dict(self.server_config)
+        # refs, the working tree and MongoDB may have moved since the last
+        # request, ancestry of commit shas can't so that cache is kept
+        self.git_commits = {}
+        self.git_changes = {}
+        self.python_migrations = {}
+        for attr in ('mongo_status','mongrate','script_hashes','bundle_payload'):
+            if hasattr(self,attr):
+                delattr(self,attr)
+        output = StringIO()
+        handler = logging.StreamHandler(output)
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+        self.logger.addHandler(handler)
+        stdout = sys.stdout
+        sys.stdout = output
+        ret = None
+        try:
+            ret = self.act(action)
+        except Exception as exp:
+            self.logger.error(exp)
+        finally:
+            sys.stdout = stdout
+            self.logger.removeHandler(handler)
+            self.args = self.server_args
+            # a fresh import each request, don't keep the old ones around
+            for name in self.python_modules:
+                sys.modules.pop(name,None)
+            del self.python_modules[:]
+        return { 'ret' : ret, 'output' : output.getvalue() }
+
     def test_run_script(self):
-        for script in self.args.test_script.split(','):
-            result = self.__load_script(script)
-            self.logger.debug("result from %s was %s" % (script, str(result)))
+        try:
+            for script in self.args.test_script.split(','):
+                result = self.__load_script(script)
+                self.logger.debug("result from %s was %s" % (script, str(result)))
+        finally:
+            self.__close_shell_session()
 
     # git specific functions
 
-    # TODO: modify this to deal with tags, branches
-    # rather than just commit sha's
+    # target_commit can be a commit sha, tag or branch, it's resolved
+    # with rev-parse and where it is in history is answered by asking git
+    # about ancestry rather than walking the whole commit list
     def get_git_changelist(self):
         rollback = False
-        target_commit = self.args.git_commit
-        self.logger.info("__get_git_changelist target_commit=%s" % target_commit)
-        git_status = self.__get_git_status()
-        current_commit = git_status['commits'][0];
-        self.logger.debug("current_commit %s" % (str(current_commit)))
-        # validate we already have the target_commit
-        # if not, then we need to pull?
-        got_target = False
-        for commit in git_status['commits']:
-            if commit.id == target_commit:
-                self.logger.debug("found target commit=%s" % str(commit))
-                got_target = True
-        if not got_target:
-            m = "target commit %s was not found in repo commits" % (target_commit)
-            raise Exception(m)
-        #if target_commit==str(current_commit):
-        #    self.logger.info("Target commit equal to current commit, nothing to do")
-        #    return rollback, []
-        c = git_status['commits']
-        target_commit_index = [i for i in range(len(c)) if c[i].id==target_commit][0]
-        self.logger.debug('target_commit_index=%s' % target_commit_index)
+        if not self.args.git_commit:
+            raise Exception("--git-commit is required to compute a change list")
+        self.logger.info("__get_git_changelist target=%s" % self.args.git_commit)
+        target_commit, current_commit = self.__get_git_target()
         mongo_status = self.__get_mongo_status()
         mongrate_commit = [s for s in mongo_status['status'] if s['_id']=='COMMIT'][0]['value']
         self.logger.debug('mongrate_commit = %s' % mongrate_commit)
         if not mongrate_commit == 0:
-            current_mongrate_commit_index = [i for i in range(len(c)) if c[i].id==mongrate_commit][0]
+            mongrate_commit = self.__resolve_git_commit(mongrate_commit)
         else:
-            current_mongrate_commit_index = 0
-        self.logger.debug('current_mongrate_commit_index=%s' % current_mongrate_commit_index)
-        self.logger.debug('target_commit_index=%s' % target_commit_index)
-        #commit list is in reverse order
-        #recent commits, then older ones
-        #so, if the index of the target commit is greater
-        # than the index of where we currently are, then it's a rollback
-        if target_commit_index > current_mongrate_commit_index:
+            mongrate_commit = current_commit
+        # if the target commit is behind where we currently are, then it's a rollback
+        if target_commit != mongrate_commit and self.__is_git_ancestor(target_commit,mongrate_commit):
             self.logger.info("Target commit before current commit, rollback = True")
             rollback = True
-        repo = self.__get_git_repo()
-        # roll forward
-        if not target_commit == current_commit.id:
-            diff = repo.git.diff(target_commit,"--name-status").split('\n')
-        else:
-            diff = repo.git.show(target_commit,"--name-status","--oneline").split('\n')[1:]
-        self.logger.debug(diff)
-        change_list = []
+        change_list = self.__get_git_changes(target_commit,current_commit,self.__get_migration_filters())
+        self.logger.debug(change_list)
+        return rollback, change_list
 
+    def __get_git_target(self):
+        """Returns (target commit sha, HEAD sha), the target must be HEAD or in it's history"""
+        git_status = self.__get_git_status()
+        current_commit = git_status['head']
+        self.logger.debug("current_commit %s" % (str(current_commit)))
+        # validate we already have the target_commit
+        # if not, then we need to pull?
+        target_commit = self.__resolve_git_commit(self.args.git_commit)
+        if not self.__is_git_ancestor(target_commit,current_commit):
+            m = "target commit %s was not found in repo commits" % (self.args.git_commit)
+            raise Exception(m)
+        self.logger.debug("found target commit=%s" % target_commit)
+        return target_commit, current_commit
+
+    def __get_migration_filters(self):
         # filter change list based on migration_home
         # run 'common' scripts and then optionally any scripts based upon
-        # distributionCenter arg
+        # distributionCenter arg, git only reports changes under these folders
         common_filter = os.path.join(self.config['migration_home'],self.config['migration_common_home'])
         self.logger.info('Filtering changes based on migration home common folder=%s' % common_filter)
+        filters = [common_filter]
         if self.args.distributionCenter:
             dc = self.args.distributionCenter
             self.logger.info('Found distributionCenter arg, adding scripts for dc %s' % dc)
-            d = os.path.join( self.config['migration_home'], dc)
-            dc_filter = dc
-        else:
-            dc_filter = None
-        self.logger.debug('common_filter=%s dc_filter=%s' % (common_filter,dc_filter))
-        for line in diff:
-            parts = line.split('\t')
-            self.logger.debug(parts)
-            add_file = False
-            add_file = common_filter in parts[1]
-            if dc_filter and dc_filter in parts[1]:
-                add_file = True
-            if add_file:
-                change_list.append( { "action" : parts[0], "file" : parts[1] } )
+            filters.append(os.path.join( self.config['migration_home'], dc))
+        self.logger.debug('filters=%s' % filters)
+        return filters
+
+    # the change list only depends on the commits and the folders, so in fleet
+    # mode targets with the same distributionCenter share one git diff
+    def __get_git_changes(self,target_commit,current_commit,filters):
+        """Returns the list of changes under the filters folders"""
+        key = (target_commit,current_commit,tuple(filters))
+        with self.git_lock:
+            if key in self.git_changes:
+                self.logger.info('using change list already computed for %s' % filters)
+                return list(self.git_changes[key])
+            # roll forward
+            if not target_commit == current_commit:
+                git_args = ["diff","--name-status","--no-renames",target_commit]
             else:
-                m = "found change %s but was not under %s" % (str(parts),self.config['migration_home'])
-                self.logger.debug(m)
-        self.logger.debug(change_list)
-        return rollback, change_list
+                git_args = ["show","--name-status","--no-renames","--format=",target_commit]
+            change_list = []
+            for action, path in self.__iter_git_name_status(git_args,filters):
+                if [f for f in filters if path.startswith(f.rstrip('/') + '/')]:
+                    change_list.append( { "action" : action, "file" : path } )
+                else:
+                    m = "found change %s but was not under %s" % (path,filters)
+                    self.logger.debug(m)
+            self.git_changes[key] = change_list
+            return list(change_list)
+
+    def __iter_git_name_status(self,git_args,paths):
+        """Run a git diff/show limited to paths and yield (action, file) for each --name-status line as it is read"""
+        shell_args = ["git"] + git_args + ["--"] + paths
+        self.logger.debug("git_args: %s" % (shell_args))
+        proc = Popen(shell_args, cwd=self.config['git'], stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        for line in proc.stdout:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) < 2:
+                continue
+            self.logger.debug(parts)
+            yield parts[0], parts[1]
+        error = proc.stderr.read()
+        if proc.wait() != 0:
+            raise Exception("git %s failed: %s" % (' '.join(git_args),error))
 
     def __get_git_status(self):
         git_status = {}
         git_status['git repo']=self.config['git']
         git_status['migration_home']=self.config['migration_home']
-        repo = self.__get_git_repo()
-        # commits() returns a list of commits with the latest commit first
-        # so the first item in the list is our current "state"
+        # HEAD is our current "state"
         # we should store this info in the 'status' collection
-        git_status['commits']=repo.commits()
+        git_status['head']=self.__resolve_git_commit('HEAD')
         return git_status
 
+    # GitPython is imported when first needed, migrate --bundle never needs it
+    def __resolve_git_commit(self,ref):
+        """Resolve a commit sha, tag or branch name to a full commit sha"""
+        from git import GitCommandError
+        if not ref in self.git_commits:
+            repo = self.__get_git_repo()
+            try:
+                self.git_commits[ref] = repo.git.rev_parse('--verify','%s^{commit}' % ref)
+            except GitCommandError as exp:
+                self.logger.debug(exp)
+                raise Exception("commit %s was not found in repo commits" % ref)
+            self.logger.debug('resolved %s to %s' % (ref,self.git_commits[ref]))
+        return self.git_commits[ref]
+
+    def __is_git_ancestor(self,ancestor,commit):
+        """True if ancestor is commit or is in it's history"""
+        from git import GitCommandError
+        key = (ancestor,commit)
+        if not key in self.git_ancestry:
+            repo = self.__get_git_repo()
+            try:
+                repo.git.merge_base('--is-ancestor',ancestor,commit)
+                self.git_ancestry[key] = True
+            except GitCommandError:
+                self.git_ancestry[key] = False
+        return self.git_ancestry[key]
+
     def __get_git_repo(self):
         if not hasattr(self,'repo'):
+            from git import Repo
             self.repo = Repo( self.config['git'] )
         return self.repo
 
     # end git specific functions
 
     # mongo specific functions
+    # the status is read once per run and cached, anything which writes
+    # the named status docs must call __invalidate_mongo_status
     def __get_mongo_status(self):
+        if hasattr(self,'mongo_status'):
+            return self.mongo_status
         mongo_status = {}
         mongo_status['mongodb']=self.config['mongodb']
         mongo = self.__get_mongo_client()
-        if not self.MONGRATE_STATUS_COLL in mongo[self.MONGRATE_DB].collection_names():
+        # named status docs (INITIALIZE, COMMIT) have string _ids, messages
+        # from __update_mongo_status have ObjectIds and are not read here
+        q = { '_id' : { '$type' : 2 } }
+        status = list(mongo[self.MONGRATE_DB][self.MONGRATE_STATUS_COLL].find(q))
+        if not status:
             self.logger.error("This MongoDB instance does not seem to be managed by mongrate")
             mongo_status['status'] = "NOT MANAGED BY MONGRATE"
         else:
-            mongo_status['status'] = list(mongo[self.MONGRATE_DB][self.MONGRATE_STATUS_COLL].find())
+            mongo_status['status'] = status
             # ensure required status docs are there
             if not [s for s in mongo_status['status'] if s['_id']=='COMMIT']:
-                mongo_status.append({'_id':'COMMIT','value':0})
-
+                mongo_status['status'].append({'_id':'COMMIT','value':0})
+        self.mongo_status = mongo_status
         return mongo_status
 
+    def __invalidate_mongo_status(self):
+        if hasattr(self,'mongo_status'):
+            del self.mongo_status
+
     def __initialize_mongo_instance(self):
         """Initializes a mongoDB instance to work with mongrate"""
         self.logger.info("initializing status in MongoDB")
         mongo = self.__get_mongo_client()
         ts = datetime.datetime.now()
         init_doc = { '_id' : 'INITIALIZE', 'ts' : ts }
+        self.__invalidate_mongo_status()
         try:
             # TODO: should we backup any existing status data?
             mongo[self.MONGRATE_DB][self.MONGRATE_STATUS_COLL].drop()
@@ -332,6 +1911,7 @@ class Mongrate():
             commit_doc = { '_id' : "COMMIT", 'value' : 0, 'ts' : ts }
             wr = mongo[self.MONGRATE_DB][self.MONGRATE_STATUS_COLL].insert_one(commit_doc)
             self.logger.debug('inserted status %s writeResult=%s' % (str(commit_doc), str(wr)))
+            self.__ensure_history_indexes()
         except Exception as exp:
             self.logger.error(exp)
             raise
@@ -339,6 +1919,7 @@ class Mongrate():
     def __update_mongo_mongrate_commit(self, commit):
         """Update status collection with info"""
         mongo = self.__get_mongo_client()
+        self.__invalidate_mongo_status()
         try:
             q = { '_id' : 'COMMIT' }
             u = { '$set' : { 'value' : commit } }
@@ -351,7 +1932,7 @@ class Mongrate():
     def __update_mongo_status(self, message):
         """Update status collection with info"""
         mongo = self.__get_mongo_client()
-        status_doc = { 'ts' : datetime.datetime.now(), "msg" : message }
+        status_doc = { 'ts' : datetime.datetime.utcnow(), "msg" : message }
         try:
             wr = mongo[self.MONGRATE_DB][self.MONGRATE_STATUS_COLL].insert_one(status_doc)
             self.logger.debug('inserted status %s writeResult=%s' % (status_doc, wr))
@@ -362,6 +1943,7 @@ class Mongrate():
 
     def __get_mongo_client(self):
         if not hasattr(self,'mongo'):
+            import pymongo
             # TODO: add in extra auth parameters here!
             try:
                 self.logger.debug("attempting connection MongoDB: " + self.config['masked_mongodb'])
@@ -373,6 +1955,7 @@ class Mongrate():
 
     def decorate_mongo_connection_string(self):
         """Adds in any runtime auth args to the connection string in the conf file."""
+        import pymongo.uri_parser
         got_user = self.args.user
         got_pwd = self.args.password
         need_to_fix_uri = False
@@ -426,23 +2009,25 @@ class Mongrate():
     # it then converts this into the format for the toposort
     # library
     # { 1 : { 2, 5 }, 5 : { 3, 7, 9 }, etc
-    # flatten = [ 1,2,5,3,7,9 ]
+    # levels = [ [ 5 ], [ 1 ] ]
+    # 2, 3, 7 and 9 aren't loaded, they were applied by an earlier run
     # https://pypi.python.org/pypi/toposort/1.0
-    def __get_scripts_toposort(self,rollback=False):
-        """Fetch scripts and dependecies (runAfter) and sort them"""
+    def __get_scripts_toposort_levels(self,rollback=False):
+        """Fetch scripts and dependecies (runAfter) and group them into levels which can run in parallel"""
+        from toposort import toposort
         mongo = self.__get_mongo_client()
         data = list(mongo['admin']['mongrate.scripts'].find({},{'runAfter':1}))
         self.logger.debug(data)
         dt = {}
         for d in data:
-            if not 'runAfter' in d:
-                d['runAfter']=[]
-            #self.logger.debug(d)
-            dt[str(d['_id'])]={str(x) for x in d['runAfter']}
-        tsort = toposort_flatten(dt)
+            dt[str(d['_id'])]={str(x) for x in d.get('runAfter',[])}
+        # runAfter can name migrations applied by an earlier run, toposort
+        # puts those in the levels too but they aren't loaded to be run
+        levels = [ sorted([x for x in level if x in dt]) for level in toposort(dt) ]
+        levels = [ level for level in levels if level ]
         if rollback:
-            tsort.reverse()
-        return tsort
+            levels.reverse()
+        return levels
 
     # actually we should load each migration and save into
     # temp collection, then we can sort and run in order
@@ -460,42 +2045,362 @@ class Mongrate():
         #eval_string += "printjson(mongrate);"
         eval_string += "eval('mongrate.tryLoad = ' + mongrate.tryLoad);"
         eval_string += "mongrate.tryLoad();"
-        shell_args.append("--eval")
-        shell_args.append(eval_string)
-        self.logger.debug("shell_args: %s" % (shell_args))
-        proc = Popen(shell_args, stdout=PIPE, stderr=PIPE)
-        output, error = proc.communicate()
-        if proc.returncode != 0:
-            self.logger.error("Error running script '%s' output:'%s' error: '%s'" % (script, output, error))
-            return False
-        else:
-            self.logger.debug("Output from '%s' was '%s'" % (script, output))
-            return True
+        return self.__eval_shell(script,eval_string)
 
-    def __run_script(self,script,rollback=False):
+    def __run_script(self,script,rollback=False,undo=False):
         """Run the up() or down() function of a script based on the _id of the migration, return True if OK, False if Error"""
         self.logger.debug("__run_script called for '"+script+"'")
+        migration = self.__get_python_migration(script)
+        if not rollback and not undo and self.args.snapshot:
+            self.__snapshot_script(script)
+        if migration is not None:
+            result = self.__run_python_script(script,migration,rollback)
+        else:
+            # scripts in a level can run on several threads, which all share self.mongrate
+            with self.lock:
+                eval_string = "mongrate = %s;" % (self.__get_mongrate_util_object_up_or_down(script,rollback))
+            #eval_string += "db=db.getSiblingDB('%s');" % self.MONGRATE_DB
+            #eval_string += "load('%s');" % (script)
+            #eval_string += "printjson(mongrate);"
+            eval_string += "eval('mongrate.tryFunc = ' + mongrate.tryFunc);"
+            eval_string += "eval('mongrate.batchUpdate = ' + mongrate.batchUpdate);"
+            eval_string += "mongrate.tryFunc();"
+            result = self.__eval_shell(script,eval_string,timeout=self.args.script_timeout)
+        if rollback:
+            # down() undoes what it knows about, collections and indexes
+            # included, then the documents from before up() go back on top
+            snapshot_run = self.__get_snapshot_run(script,undo)
+            if snapshot_run:
+                result = self.__restore_snapshots(script,snapshot_run) and result
+        # checkpoints are only needed to resume a function which didn't finish
+        if result:
+            self.__clear_checkpoints(script)
+        return result
+
+    # with --snapshot the documents a migration declares it touches (see
+    # --estimate) are copied before it's up() runs, with a $match and $out
+    # into mongrate.snapshot.<run id>.<n> next to the collection, and listed
+    # in admin.mongrate.snapshots. After down() has run they are put back
+    # with bulk replaces:
+    #
+    #   undo       the snapshots taken by this run, for a failed up() only
+    #              this is done, it's down() isn't run
+    #   rollback   only with --snapshot, the snapshots of the run which last
+    #              applied the migration, anything written since is replaced
+    #
+    # documents up() inserted, and collections and indexes it created, are
+    # left to down(). Snapshots older than --snapshot-days are dropped by migrate
+    def __snapshot_script(self,script):
+        """Copy the documents script declares it touches to snapshot collections"""
+        from bson import json_util
+        mongo = self.__get_mongo_client()
+        doc = mongo[self.MONGRATE_DB][self.MONGRATE_WORKING_SCRIPT_COLL].find_one({ '_id' : script },{ 'mongrateFile' : 1 }) or {}
+        # read from the file like --estimate does, filters with operators can't be stored with the migration
+        meta = self.__get_estimate_metadata([doc['mongrateFile']]).get(doc['mongrateFile']) if 'mongrateFile' in doc else None
+        touches = (meta or {}).get('touches') or []
+        if not touches:
+            self.logger.info('%s does not declare the collections it touches, no snapshot taken' % script)
+            return
+        catalog = mongo[self.MONGRATE_DB][self.MONGRATE_SNAPSHOT_COLL]
+        for i in range(len(touches)):
+            started = time.time()
+            db_name = touches[i].get('db') or self.__get_migration_db().name
+            coll_name = touches[i]['collection']
+            query = touches[i].get('filter') or {}
+            snapshot = 'mongrate.snapshot.%s.%s' % (self.run['_id'],uuid.uuid4().hex[:8])
+            mongo[db_name][coll_name].aggregate([ { '$match' : query }, { '$out' : snapshot } ])
+            entry = { '_id' : '%s.%s.%d' % (self.run['_id'],script,i),
+                      'run' : self.run['_id'],
+                      'migration' : script,
+                      'db' : db_name,
+                      'collection' : coll_name,
+                      # as extended json, operators can't be field names
+                      'filter' : json_util.dumps(query),
+                      'snapshot' : snapshot,
+                      'documents' : mongo[db_name][snapshot].count_documents({}),
+                      'created' : datetime.datetime.now() }
+            catalog.insert_one(entry)
+            self.logger.info('snapshot of %s %s.%s %s documents in %s' % (script,db_name,coll_name,entry['documents'],snapshot))
+            with self.lock:
+                self.run.setdefault('snapshots',[]).append({ 'migration' : script, 'db' : db_name, 'collection' : coll_name,
+                    'snapshot' : snapshot, 'documents' : entry['documents'], 'seconds' : round(time.time() - started,3) })
+
+    def __get_snapshot_run(self,script,undo):
+        """The run whose snapshots of script a down() should be followed by restoring, None for none"""
+        import pymongo
+        if undo:
+            return self.run['_id']
+        if not self.args.snapshot:
+            return None
+        mongo = self.__get_mongo_client()
+        q = { 'script' : script, 'func' : 'up', 'phase' : 'execute', 'result' : True }
+        last = mongo[self.MONGRATE_DB][self.MONGRATE_HISTORY_SCRIPT_COLL].find_one(q,{ 'run' : 1 },sort=[('start',pymongo.DESCENDING)])
+        if not last:
+            self.logger.info('no run applying %s in the history, no snapshot to restore' % script)
+            return None
+        return last['run']
+
+    def __restore_snapshots(self,script,run_id):
+        """Put back the documents saved by run_id before the up() of script, return True if OK, False if Error"""
+        import pymongo
+        from bson.son import SON
+        from bson.codec_options import CodecOptions
+        mongo = self.__get_mongo_client()
+        catalog = mongo[self.MONGRATE_DB][self.MONGRATE_SNAPSHOT_COLL]
+        q = { 'run' : run_id, 'migration' : script, 'restored' : { '$exists' : False } }
+        snapshots = list(catalog.find(q))
+        if not snapshots:
+            self.logger.info('no snapshot of %s from run %s to restore' % (script,run_id))
+            return True
+        for s in snapshots:
+            if not s['snapshot'] in mongo[s['db']].list_collection_names():
+                self.logger.error('snapshot %s of %s is missing, only down() was run' % (s['snapshot'],script))
+                return False
+        for s in snapshots:
+            started = time.time()
+            self.logger.info('restoring %s.%s for %s from %s' % (s['db'],s['collection'],script,s['snapshot']))
+            # SON keeps the field order of the documents
+            source = mongo[s['db']].get_collection(s['snapshot'],codec_options=CodecOptions(document_class=SON))
+            coll = mongo[s['db']][s['collection']]
+            restored = 0
+            ops = []
+            for doc in source.find().batch_size(MigrationHelper.BATCH_SIZE):
+                ops.append(pymongo.ReplaceOne({ '_id' : doc['_id'] },doc,upsert=True))
+                if len(ops) == MigrationHelper.BATCH_SIZE:
+                    coll.bulk_write(ops,ordered=False)
+                    restored += len(ops)
+                    ops = []
+            if ops:
+                coll.bulk_write(ops,ordered=False)
+                restored += len(ops)
+            catalog.update_one({ '_id' : s['_id'] },{ '$set' : { 'restored' : datetime.datetime.now(), 'restoredBy' : self.run['_id'] } })
+            self.logger.info('restored %s documents of %s.%s for %s' % (restored,s['db'],s['collection'],script))
+            with self.lock:
+                self.run.setdefault('restores',[]).append({ 'migration' : script, 'db' : s['db'], 'collection' : s['collection'],
+                    'snapshot' : s['snapshot'], 'documents' : restored, 'seconds' : round(time.time() - started,3) })
+        return True
+
+    def __prune_snapshots(self):
+        """Drop snapshots older than --snapshot-days"""
+        mongo = self.__get_mongo_client()
+        catalog = mongo[self.MONGRATE_DB][self.MONGRATE_SNAPSHOT_COLL]
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=self.args.snapshot_days)
+        for s in catalog.find({ 'created' : { '$lt' : cutoff } }):
+            self.logger.info('dropping snapshot %s of %s from %s' % (s['snapshot'],s['migration'],s['created']))
+            mongo[s['db']].drop_collection(s['snapshot'])
+            catalog.delete_one({ '_id' : s['_id'] })
+
+    def __clear_checkpoints(self,script):
+        mongo = self.__get_mongo_client()
+        q = { 'migration' : script }
+        wr = mongo[self.MONGRATE_DB][self.MONGRATE_CHECKPOINT_COLL].delete_many(q)
+        self.logger.debug('cleared checkpoints %s deleted=%s' % (str(q),wr.deleted_count))
+
+    # load every script in one shell round trip, the tryLoad for
+    # each script is written to a bundle file which is then load()'ed
+    # and each script prints a marker so we can report on them one by one
+    def __load_scripts(self,scripts):
+        """Load a list of scripts with one mongo shell command, returns a dict of script -> True if OK, False if Error"""
+        self.logger.debug("__load_scripts called for %s scripts" % len(scripts))
+        for script in scripts:
+            self.__get_mongrate_util_object_on_load(script)
+        lines = []
+        lines.append("mongrate = %s;" % json.dumps({ 'meta' : self.mongrate['meta'] }))
+        for i in range(len(scripts)):
+            script = scripts[i]
+            lines.append("try {")
+            lines.append("    delete mongrate.exports;")
+            lines.append("    db = db.getSiblingDB('%s');" % self.MONGRATE_DB)
+            lines.append("    load(%s);" % json.dumps(script))
+            lines.append("    mongrate.tryLoad = %s;" % self.__get_try_load_function(script))
+            lines.append("    mongrate.tryLoad();")
+            lines.append("    print('%s %d');" % (self.LOADED_MARKER,i))
+            lines.append("} catch(error) {")
+            lines.append("    print(error);")
+            lines.append("    print('%s %d');" % (self.LOAD_FAILED_MARKER,i))
+            lines.append("}")
+        fd, bundle = tempfile.mkstemp(prefix='mongrate-load-',suffix='.js')
+        try:
+            f = os.fdopen(fd,'w')
+            f.write('\n'.join(lines))
+            f.write('\n')
+            f.close()
+            self.logger.debug("wrote load bundle %s" % bundle)
+            results = {}
+            script_output = deque(maxlen=ShellOutput.TAIL_LINES)
+            # markers come out as each script is loaded
+            def on_line(line):
+                parts = line.strip().split(' ')
+                if len(parts)==2 and parts[0] in (self.LOADED_MARKER,self.LOAD_FAILED_MARKER):
+                    script = scripts[int(parts[1])]
+                    results[script] = parts[0]==self.LOADED_MARKER
+                    if not results[script]:
+                        self.logger.error("Error loading script '%s' output:'%s'" % (script, '\n'.join(script_output)))
+                    script_output.clear()
+                else:
+                    script_output.append(line)
+            ok, output = self.__eval_shell_output("load bundle %s" % bundle,"load(%s);" % json.dumps(bundle),on_line)
+        finally:
+            os.remove(bundle)
+        for script in scripts:
+            if not script in results:
+                self.logger.error("No load result reported for script '%s'" % script)
+                results[script] = False
+        if not ok:
+            self.logger.error("Error running load bundle output:'%s'" % output)
+        return results
+
+    # python migrations are modules with _id, runAfter, up(db) and down(db)
+    # they run in this process with the pymongo client instead of the
+    # mongo shell, their metadata is stored with the javascript ones
+    # so they are sorted together
+    def __is_python_migration(self,script):
+        return script.endswith('.py')
+
+    def __import_python_migration(self,script):
+        name = 'mongrate_migration_%s' % str(uuid.uuid4()).replace('-','')
+        self.logger.debug("importing python migration %s as %s" % (script,name))
+        with self.lock:
+            self.python_modules.append(name)
+        return imp.load_source(name,script)
+
+    def __load_python_script(self,script):
+        """Import a python migration and store it for sorting, return True if OK, False if Error"""
+        self.logger.debug("__load_python_script called for '"+script+"'")
+        try:
+            migration = self.__import_python_migration(script)
+            if not hasattr(migration,'_id'):
+                raise Exception('%s missing _id' % script)
+            if hasattr(migration,'onLoad'):
+                self.logger.info('Calling onLoad for %s' % script)
+                migration.onLoad(self.__get_migration_db())
+            else:
+                self.logger.info('No onLoad found for %s' % script)
+            doc = { '_id' : migration._id,
+                    'runAfter' : list(getattr(migration,'runAfter',[])),
+                    'indexes' : list(getattr(migration,'indexes',[])),
+                    'mongrateType' : 'python',
+                    'mongrateFile' : script,
+                    'mongrateHash' : self.script_hashes.get(script) }
+            mongo = self.__get_mongo_client()
+            wr = mongo[self.MONGRATE_DB][self.MONGRATE_WORKING_SCRIPT_COLL].insert_one(doc)
+            self.logger.debug('inserted migration %s writeResult=%s' % (str(doc), str(wr)))
+            with self.lock:
+                self.python_migrations[migration._id] = migration
+            return True
+        except Exception as exp:
+            self.logger.error("Error loading script '%s' error: '%s'" % (script, exp))
+            return False
+
+    def __get_python_migration(self,script):
+        """Returns the python migration module for the migration _id, or None if it is a javascript migration"""
+        with self.lock:
+            if not script in self.python_migrations:
+                # stored by an earlier run and skipped by the script cache
+                mongo = self.__get_mongo_client()
+                q = { '_id' : script, 'mongrateType' : 'python' }
+                doc = mongo[self.MONGRATE_DB][self.MONGRATE_WORKING_SCRIPT_COLL].find_one(q,{'mongrateFile':1})
+                if doc:
+                    self.python_migrations[script] = self.__import_python_migration(doc['mongrateFile'])
+                else:
+                    self.python_migrations[script] = None
+            return self.python_migrations[script]
+
+    def __run_python_script(self,script,migration,rollback=False):
+        """Run the up(db) or down(db) function of a python migration, return True if OK, False if Error"""
+        func = 'up'
+        if rollback:
+            func = 'down'
+        try:
+            self.logger.info('Calling %s() for %s' % (func,script))
+            # like the mongrate object javascript migrations get
+            migration.mongrate = MigrationHelper(self.__get_mongo_client(),script,func,self.logger,
+                                                 self.args.max_lag,self.config['mongodb'],
+                                                 self.__get_jobs() == 1 and not self.fleet_target)
+            try:
+                getattr(migration,func)(self.__get_migration_db())
+            finally:
+                with self.lock:
+                    self.run_throttle[script] = migration.mongrate.replication_throttle.get_stats()
+            self.logger.info('%s() for %s complete' % (func,script))
+            return True
+        except Exception as exp:
+            self.logger.error("Error running script '%s' error: '%s'" % (script, exp))
+            return False
+
+    def __get_migration_db(self):
+        """The database from the connection string, like db in the mongo shell"""
+        import pymongo.errors
+        mongo = self.__get_mongo_client()
+        try:
+            return mongo.get_default_database()
+        except pymongo.errors.ConfigurationError:
+            return mongo['test']
+
+    def __eval_shell(self,script,eval_string,timeout=None):
+        """Evaluate eval_string in the mongo shell session, or in a new mongo process when there is no session, return True if OK, False if Error"""
+        ok, output = self.__eval_shell_output(script,eval_string,timeout=timeout)
+        if ok:
+            self.logger.debug("'%s' complete" % script)
+        else:
+            self.logger.error("Error running script '%s' output:'%s'" % (script, output))
+        return ok
+
+    # output is logged line by line as the shell prints it, only the
+    # tail is kept and returned, on_line is called for every line
+    def __eval_shell_output(self,script,eval_string,on_line=None,timeout=None):
+        """Evaluate eval_string, returns (ok, output)"""
+        heartbeat = self.args.heartbeat or ShellOutput.HEARTBEAT
+        session = self.__get_shell_session()
+        if session is not None:
+            ok, output = session.send(eval_string,label=script,on_line=on_line,timeout=timeout)
+            if not ok and not session.is_alive():
+                # we can't tell how far the command got, so don't retry it,
+                # but run anything after this in it's own process
+                self.logger.error('mongo shell session died running %s, falling back to one mongo process per script' % script)
+                self.shell_local.session = None
+            return ok, output
         shell_args = []
         shell_args.append("mongo")
-        # TODO: deal with auth creds given from mongrate args
         shell_args.append(self.config['mongodb'])
-        eval_string = "mongrate = %s;" % (self.__get_mongrate_util_object_up_or_down(script,rollback))
-        #eval_string += "db=db.getSiblingDB('%s');" % self.MONGRATE_DB
-        #eval_string += "load('%s');" % (script)
-        #eval_string += "printjson(mongrate);"
-        eval_string += "eval('mongrate.tryFunc = ' + mongrate.tryFunc);"
-        eval_string += "mongrate.tryFunc();"
         shell_args.append("--eval")
         shell_args.append(eval_string)
         self.logger.debug("shell_args: %s" % (shell_args))
-        proc = Popen(shell_args, stdout=PIPE, stderr=PIPE)
-        output, error = proc.communicate()
-        if proc.returncode != 0:
-            self.logger.error("Error running script '%s' output:'%s' error: '%s'" % (script, output, error))
-            return False
-        else:
-            self.logger.debug("Output from '%s' was '%s'" % (script, output))
-            return True
+        proc = Popen(shell_args, stdout=PIPE, stderr=STDOUT, universal_newlines=True)
+        line, output, timed_out = ShellOutput(proc.stdout,self.logger).follow(script,(),on_line,timeout,heartbeat)
+        if timed_out:
+            self.logger.error('killing mongo pid=%s, operations it started may still be running on the server' % proc.pid)
+            proc.kill()
+        proc.wait()
+        return proc.returncode == 0 and not timed_out, output
+
+    # each thread gets it's own shell session, a session
+    # can only run one command at a time
+    def __get_shell_session(self):
+        """Returns the MongoShellSession for this thread, or None to run each script in it's own mongo process"""
+        if not hasattr(self.shell_local,'session'):
+            self.shell_local.session = None
+            if self.args.no_shell_session:
+                self.logger.debug('--no-shell-session set, running one mongo process per script')
+                return None
+            try:
+                session = MongoShellSession(self.config['mongodb'],self.logger,self.args.heartbeat or ShellOutput.HEARTBEAT)
+                session.start()
+                self.shell_local.session = session
+                with self.lock:
+                    self.shell_sessions.append(session)
+            except Exception as exp:
+                self.logger.error(exp)
+                self.logger.info('unable to start mongo shell session, falling back to one mongo process per script')
+        return self.shell_local.session
+
+    def __close_shell_session(self):
+        with self.lock:
+            for session in self.shell_sessions:
+                session.close()
+            self.shell_sessions = []
+        self.shell_local = threading.local()
+
     def __get_mongrate_util_object_on_load(self,script):
         if not hasattr(self,'mongrate'):
             m = {}
@@ -511,6 +2416,11 @@ class Mongrate():
             self.mongrate['meta']['migrations'].append(script)
 
         m = {}
+        m['tryLoad'] = self.__get_try_load_function(script)
+        self.mongrate['tryLoad']=m['tryLoad']
+        return json.dumps(self.mongrate)
+
+    def __get_try_load_function(self,script):
         # tryLoad will do checking on a given migration for required
         # things, and then insert the migration into a collection for later processing
         try_load="""function() {
@@ -527,6 +2437,10 @@ class Mongrate():
             } else {
                 print('No onLoad found for %s');
             }
+            // touches are read from the file, filters with operators can't be stored
+            delete mongrate.exports.touches;
+            mongrate.exports.mongrateFile = '%s';
+            mongrate.exports.mongrateHash = %s;
             var r = db.getSiblingDB('%s').getCollection('%s').insert(mongrate.exports);
             if ( r.getWriteError() ) {
                 throw r.getWriteError().errmsg;
@@ -534,9 +2448,8 @@ class Mongrate():
 
         }"""
         try_load = try_load.replace('\"','')
-        m['tryLoad'] = try_load % (script,script,script,self.MONGRATE_DB,self.MONGRATE_WORKING_SCRIPT_COLL)
-        self.mongrate['tryLoad']=m['tryLoad']
-        return json.dumps(self.mongrate)
+        blob_hash = json.dumps(getattr(self,'script_hashes',{}).get(script))
+        return try_load % (script,script,script,script,blob_hash,self.MONGRATE_DB,self.MONGRATE_WORKING_SCRIPT_COLL)
 
     def __get_mongrate_util_object_up_or_down(self,script,rollback=False):
         if not hasattr(self,'mongrate'):
@@ -576,11 +2489,109 @@ class Mongrate():
         c = self.MONGRATE_WORKING_SCRIPT_COLL
         m['tryFunc'] = try_func % (d,c,script,script,d,c,func,script,func,func,script)
         self.mongrate['tryFunc']=m['tryFunc']
+        self.mongrate['current'] = { '_id' : script, 'func' : func }
+        self.mongrate['batchUpdate'] = self.__get_batch_update_function()
         return json.dumps(self.mongrate)
 
-    def __clean_stored_migrations(self):
+    # mongrate.batchUpdate(dbName, collName, fn, options) for migrations
+    # fn(doc) returns an update like { '$set' : {...} } or null to skip the doc
+    # options are query, batchSize and name (to tell apart more than one
+    # batchUpdate on the same collection), same as MigrationHelper.batch_update
+    def __get_batch_update_function(self):
+        batch_update = """function(dbName, collName, fn, options) {
+            options = options || {};
+            var query = options.query || {};
+            var batchSize = options.batchSize || %s;
+            var key = [mongrate.current._id, mongrate.current.func, dbName, collName].join('.');
+            if (options.name) {
+                key += '.' + options.name;
+            }
+            var checkpoints = db.getSiblingDB('%s').getCollection('%s');
+            var cp = checkpoints.findOne( { '_id' : key } ) || { 'processed' : 0 };
+            if (cp.done) {
+                print('batchUpdate ' + key + ' already complete');
+                return cp.processed;
+            }
+            if (Object.keys(cp).indexOf('lastId')!=-1) {
+                print('batchUpdate ' + key + ' resuming after ' + tojson(cp.lastId));
+            }
+            var coll = db.getSiblingDB(dbName).getCollection(collName);
+            while (true) {
+                var q = query;
+                if (Object.keys(cp).indexOf('lastId')!=-1) {
+                    q = { '$and' : [ query, { '_id' : { '$gt' : cp.lastId } } ] };
+                }
+                var docs = coll.find(q).sort( { '_id' : 1 } ).limit(batchSize).toArray();
+                if (docs.length==0) {
+                    break;
+                }
+                var bulk = coll.initializeUnorderedBulkOp();
+                var ops = 0;
+                docs.forEach(function(doc) {
+                    var u = fn(doc);
+                    if (u) {
+                        bulk.find( { '_id' : doc._id } ).updateOne(u);
+                        ops++;
+                    }
+                });
+                if (ops > 0) {
+                    bulk.execute();
+                }
+                cp.lastId = docs[docs.length-1]._id;
+                cp.processed += docs.length;
+                checkpoints.update( { '_id' : key },
+                    { '$set' : { 'migration' : mongrate.current._id, 'lastId' : cp.lastId, 'processed' : cp.processed, 'ts' : new Date() } },
+                    { 'upsert' : true } );
+                print('batchUpdate ' + key + ' processed ' + cp.processed);
+            }
+            checkpoints.update( { '_id' : key },
+                { '$set' : { 'migration' : mongrate.current._id, 'done' : true, 'processed' : cp.processed, 'ts' : new Date() } },
+                { 'upsert' : true } );
+            return cp.processed;
+        }"""
+        batch_update = batch_update.replace('\"','')
+        return batch_update % (MigrationHelper.BATCH_SIZE,self.MONGRATE_DB,self.MONGRATE_CHECKPOINT_COLL)
+
+    def __get_script_hashes(self,scripts):
+        """Returns a dict of script -> git blob sha of the script contents"""
+        existing = [s for s in scripts if os.path.isfile(s)]
+        if not existing:
+            return {}
+        shell_args = ["git","hash-object","--stdin-paths"]
+        self.logger.debug("git_args: %s" % (shell_args))
+        proc = Popen(shell_args, cwd=self.config['git'], stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        output, error = proc.communicate('\n'.join(existing) + '\n')
+        if proc.returncode != 0:
+            raise Exception("git hash-object failed: %s" % error)
+        hashes = dict(zip(existing,output.split()))
+        self.logger.debug('script hashes=%s' % hashes)
+        return hashes
+
+    # the working script collection is kept between runs, each stored
+    # migration carries the file it came from and the blob sha of it's
+    # contents, so only new or changed scripts need to be loaded again
+    def __sync_stored_migrations(self,scripts):
+        """Remove stored migrations which are not in scripts or whose content changed, returns the scripts which need loading"""
+        import pymongo
         mongo = self.__get_mongo_client()
-        mongo[self.MONGRATE_DB][self.MONGRATE_WORKING_SCRIPT_COLL].drop()
+        coll = mongo[self.MONGRATE_DB][self.MONGRATE_WORKING_SCRIPT_COLL]
+        wanted = set(scripts)
+        loaded = set()
+        stale = []
+        for d in coll.find({},{'mongrateFile':1,'mongrateHash':1}):
+            f = d.get('mongrateFile')
+            if f in wanted and not f in loaded and d.get('mongrateHash') == self.script_hashes.get(f):
+                loaded.add(f)
+            else:
+                stale.append(d['_id'])
+        self.logger.debug('stored migrations loaded=%s stale=%s' % (loaded,stale))
+        if stale:
+            if not self.DRY_RUN:
+                wr = coll.bulk_write([ pymongo.DeleteOne({ '_id' : _id }) for _id in stale ],ordered=False)
+                self.logger.debug('removed stale migrations %s writeResult=%s' % (stale,wr.bulk_api_result))
+            else:
+                self.logger.info("--dry-run: would have removed stale migrations %s" % stale)
+        return [s for s in scripts if not s in loaded]
 
     # generate JSON for mongrate state object
     # which gets passed into each migration
@@ -604,9 +2615,270 @@ class Mongrate():
 
     # end mongo specific functions
 
-    def __compile_migrations(self):
-        print "__compile"
+    # plans, the run order worked out from the migrations' _id and runAfter
+    # as they are in the working tree migrate runs, without loading them
+    # into MongoDB. runAfter may name any migration in the tree at the target
+    # commit, ones which aren't being run were applied before and are left
+    # out of the levels
+    #
+    # { 'commit' : sha, 'filters' : [...], 'scripts' : { file : { '_id', 'runAfter', 'hash' } },
+    #   'levels' : [ [ _id, ... ], ... ], 'errors' : [...] }
+    def __compile_migrations(self,commit,filters,change_list,contents=None):
+        """Read the metadata of the changed migrations and work out the toposort levels, contents is filled with path -> file contents if given"""
+        from toposort import toposort, CircularDependencyError
+        plan = { 'commit' : commit, 'filters' : filters, 'created' : str(datetime.datetime.now()),
+                 'scripts' : {}, 'levels' : [], 'errors' : [] }
+        # the same files, and hashes, migrate would load
+        files = [c['file'] for c in change_list if os.path.isfile(os.path.join(self.config['git'],c['file']))]
+        hashes = self.__get_script_hashes([os.path.join(self.config['git'],path) for path in files])
+        ids = {}
+        for path in files:
+            filename = os.path.join(self.config['git'],path)
+            f = open(filename)
+            content = f.read()
+            f.close()
+            try:
+                meta = self.__parse_migration_metadata(path,content)
+            except Exception as exp:
+                plan['errors'].append('%s: %s' % (path,exp))
+                continue
+            if meta['_id'] in ids:
+                plan['errors'].append('%s: _id %s is also used by %s' % (path,meta['_id'],ids[meta['_id']]))
+                continue
+            ids[meta['_id']] = path
+            meta['hash'] = hashes[filename]
+            plan['scripts'][path] = meta
+            if contents is not None:
+                contents[path] = content
+        missing = set()
+        for meta in plan['scripts'].values():
+            missing.update([dep for dep in meta['runAfter'] if not dep in ids])
+        if missing:
+            missing = missing - self.__get_tree_migration_ids(commit,filters)
+        dt = {}
+        for path, meta in plan['scripts'].items():
+            for dep in meta['runAfter']:
+                if dep in missing:
+                    plan['errors'].append('%s: runAfter %s is not a migration at %s' % (path,dep,commit))
+            dt[meta['_id']] = set(meta['runAfter'])
+        try:
+            levels = [ sorted([x for x in level if x in dt]) for level in toposort(dt) ]
+            plan['levels'] = [ level for level in levels if level ]
+        except CircularDependencyError as exp:
+            plan['errors'].append('runAfter cycle: %s' % exp)
+        return plan
+
+    def __get_tree_migration_ids(self,commit,filters):
+        """The _id of every migration under the filters folders at commit"""
+        tree = self.__get_git_tree(commit,filters)
+        ids = set()
+        for path, blob_hash, content in self.__read_git_blobs(commit,sorted(tree.keys())):
+            try:
+                ids.add(self.__parse_migration_metadata(path,content)['_id'])
+            except Exception as exp:
+                self.logger.debug('%s at %s: %s' % (path,commit,exp))
+        return ids
+
+    def __read_git_blobs(self,commit,paths):
+        """Yields (path, blob sha, contents) for each path at commit, contents is None if it isn't there"""
+        if not paths:
+            return
+        shell_args = ["git","cat-file","--batch"]
+        self.logger.debug("git_args: %s" % (shell_args))
+        proc = Popen(shell_args, cwd=self.config['git'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        # write all the requests on a thread so a large batch can't fill both pipes
+        def write():
+            for path in paths:
+                proc.stdin.write('%s:%s\n' % (commit,path))
+            proc.stdin.close()
+        writer = threading.Thread(target=write)
+        writer.start()
+        for path in paths:
+            header = proc.stdout.readline().split()
+            if len(header) < 3 or header[-1] == 'missing':
+                yield path, None, None
+                continue
+            content = proc.stdout.read(int(header[2]))
+            proc.stdout.read(1)
+            yield path, header[0], content
+        writer.join()
+        proc.wait()
 
+    def __parse_migration_metadata(self,path,content):
+        """Returns { '_id', 'runAfter' } of a migration from it's source, without running it"""
+        if self.__is_python_migration(path):
+            meta = {}
+            for node in ast.parse(content,path).body:
+                if isinstance(node,ast.Assign):
+                    for target in node.targets:
+                        if isinstance(target,ast.Name) and target.id in ('_id','runAfter'):
+                            meta[target.id] = ast.literal_eval(node.value)
+        else:
+            # javascript migrations follow the generated template, _id and
+            # runAfter must be literals in the exported migration
+            meta = {}
+            m = re.search(r"""['"]?_id['"]?\s*:\s*['"]([^'"]+)['"]""",content)
+            if m:
+                meta['_id'] = m.group(1)
+            m = re.search(r"""['"]?runAfter['"]?\s*:\s*\[([^\]]*)\]""",content)
+            if m:
+                meta['runAfter'] = re.findall(r"""['"]([^'"]+)['"]""",m.group(1))
+        if not '_id' in meta:
+            raise Exception('missing _id')
+        meta['_id'] = str(meta['_id'])
+        meta['runAfter'] = [str(x) for x in meta.get('runAfter',[])]
+        return meta
+
+    def __get_plan_filename(self,commit):
+        name = 'mongrate-plan-%s' % commit
+        if self.args.distributionCenter:
+            name += '-%s' % self.args.distributionCenter
+        return os.path.join(self.config.get('plan_dir','.'),name + '.json')
+
+    def __read_plan(self,scripts):
+        """Read the --plan file, or the plan in the --bundle, and check it matches this run, returns it's levels"""
+        if self.args.bundle:
+            plan = self.bundle_payload['plan']
+            source = self.args.bundle
+        else:
+            plan = json.load(open(self.args.plan))
+            source = self.args.plan
+        if plan['filters'] != self.__get_migration_filters():
+            raise Exception('plan %s is for folders %s, check --distributionCenter' % (source,plan['filters']))
+        commit = self.run['commit']
+        if plan['commit'] != commit:
+            raise Exception('plan %s is for commit %s not %s' % (source,plan['commit'],commit))
+        planned = dict([(str(k),v) for k,v in plan['scripts'].items()])
+        for script in scripts:
+            path = os.path.relpath(script,self.config['git'])
+            if not path in planned:
+                raise Exception('plan %s has no entry for %s' % (source,script))
+            if planned[path]['hash'] != self.script_hashes.get(script):
+                raise Exception('%s has changed since plan %s was made' % (script,source))
+        return [ [str(x) for x in level] for level in plan['levels'] ]
+
+    # bundles carry everything migrate needs from git for one target commit,
+    # so production hosts don't need a clone, the file is gzip'ed json:
+    #
+    # { 'checksum' : sha256 of the payload, 'payload' : { 'target', 'head', 'newer',
+    #   'filters', 'changes', 'plan', 'files' : { path : contents } } }
+    def __read_bundle(self):
+        """Read and verify the --bundle file and unpack it's migrations, returns the payload"""
+        if not hasattr(self,'bundle_payload'):
+            f = gzip.open(self.args.bundle,'rb')
+            bundle = json.loads(f.read())
+            f.close()
+            checksum = self.__get_bundle_checksum(bundle['payload'])
+            if checksum != bundle['checksum']:
+                raise Exception('bundle %s is corrupt, checksum %s does not match %s' % (self.args.bundle,checksum,bundle['checksum']))
+            for path in bundle['payload']['files']:
+                if os.path.isabs(path) or os.path.normpath(path).split(os.sep)[0] == os.pardir:
+                    raise Exception('bundle %s has a file outside it\'s folder: %s' % (self.args.bundle,path))
+            self.bundle_payload = bundle['payload']
+            # unpack to the same place every time for the same bundle, so
+            # stored migrations keep matching on a retry
+            bundle_dir = os.path.join(self.config.get('bundle_dir',tempfile.gettempdir()),'mongrate-bundle-%s' % checksum[:16])
+            self.__make_private_dir(bundle_dir)
+            for path, content in self.bundle_payload['files'].items():
+                filename = os.path.join(bundle_dir,path)
+                if not os.path.isdir(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename))
+                f = open(filename,'w')
+                f.write(content.encode('utf-8'))
+                f.close()
+            self.config['git'] = bundle_dir
+            self.logger.info('unpacked bundle %s for commit %s to %s' % (self.args.bundle,self.bundle_payload['target'],bundle_dir))
+        return self.bundle_payload
+
+    def __make_private_dir(self,path):
+        """Create path readable only by us, or check an existing one is, the name is predictable so it could be made by someone else first"""
+        import errno, stat
+        try:
+            os.mkdir(path,0700)
+        except OSError as exp:
+            if exp.errno != errno.EEXIST:
+                raise
+        st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0077:
+            raise Exception('%s is not a directory owned by and only accessible to this user, remove it and retry' % path)
+
+    def __get_bundle_checksum(self,payload):
+        return hashlib.sha256(json.dumps(payload,sort_keys=True,separators=(',',':'))).hexdigest()
+
+    def __get_bundle_changelist(self):
+        """Like get_git_changelist, from the --bundle"""
+        bundle = self.__read_bundle()
+        if self.args.git_commit and not bundle['target'].startswith(self.args.git_commit):
+            raise Exception('bundle %s is for commit %s not %s' % (self.args.bundle,bundle['target'],self.args.git_commit))
+        # a bundle only has the migrations of the distributionCenter it was made for
+        if bundle['filters'] != self.__get_migration_filters():
+            raise Exception('bundle %s is for folders %s, check --distributionCenter' % (self.args.bundle,bundle['filters']))
+        mongo_status = self.__get_mongo_status()
+        mongrate_commit = [s for s in mongo_status['status'] if s['_id']=='COMMIT'][0]['value']
+        self.logger.debug('mongrate_commit = %s' % mongrate_commit)
+        if mongrate_commit == 0:
+            mongrate_commit = bundle['head']
+        # newer is every commit after the target up to the head the
+        # bundle was made from, being on one of them means rolling back
+        rollback = False
+        if mongrate_commit != bundle['target'] and mongrate_commit in bundle['newer']:
+            self.logger.info("Target commit before current commit, rollback = True")
+            rollback = True
+        change_list = [ { "action" : str(c['action']), "file" : str(c['file']) } for c in bundle['changes'] ]
+        return rollback, change_list
+
+    def __get_bundle_script_hashes(self):
+        bundle = self.__read_bundle()
+        hashes = {}
+        for path, meta in bundle['plan']['scripts'].items():
+            hashes[os.path.join(self.config['git'],str(path))] = str(meta['hash'])
+        return hashes
+
+def get_server_socket(config):
+    return config.get('socket','/tmp/mongrate.sock')
+
+def get_server_identity(config):
+    """The config, with MongoDB credentials removed and absolute paths, a server only runs requests for the same one"""
+    identity = dict([(k,v) for k,v in config.items() if not k in Mongrate.SERVER_IGNORED_CONFIG])
+    mongodb = config.get('original.mongodb',config['mongodb'])
+    identity['mongodb'] = re.sub(r'^(mongodb(\+srv)?://)[^@/]*@',r'\1',mongodb)
+    for k in Mongrate.SERVER_PATH_CONFIG:
+        if identity.get(k):
+            identity[k] = os.path.abspath(identity[k])
+    # as the client sends it, json has no tuples or str/unicode difference
+    return json.loads(json.dumps(identity,default=str))
+
+def get_server_request(args,config):
+    """The request for a server to run the action in args, without credentials and with absolute paths"""
+    request_args = dict([(k,v) for k,v in vars(args).items() if not k in Mongrate.SERVER_FIXED_ARGS])
+    for k in Mongrate.SERVER_PATH_ARGS:
+        if request_args.get(k):
+            request_args[k] = os.path.abspath(request_args[k])
+    return { 'action' : args.action, 'args' : request_args, 'config' : get_server_identity(config) }
+
+def forward_to_server(path,args,logger,config=None):
+    """Send the action in args, for the MongoDB and git of config, to a running 'serve', returns the reply or None if no server is running, args None only checks"""
+    if not os.path.exists(path):
+        return None
+    client = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error as exp:
+        logger.debug('no server on %s: %s' % (path,exp))
+        client.close()
+        return None
+    try:
+        if args is None:
+            return {}
+        logger.info('forwarding %s action to server on %s' % (args.action,path))
+        f = client.makefile('rw')
+        f.write(json.dumps(get_server_request(args,config)) + '\n')
+        f.flush()
+        reply = json.loads(f.read())
+        f.close()
+        return reply
+    finally:
+        client.close()
 
 # 'main' starts here
 
@@ -615,20 +2887,61 @@ def main():
     description = u'mongrate - a MongoDB migration \U0001F528 \U0001F415 \U0001F3CB \U0001F3D1'
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument("-a","--action",default="status"
-                        ,help='Action to perform. status, migrate, generate_migration, default is \'status\'')
+                        ,help='Action to perform. status, migrate, verify, history, plan, bundle, serve, generate_template_migration, default is \'status\'')
     parser.add_argument("-f","--config",default="./mongrate.conf",help='Configuration file see docs')
     parser.add_argument("--git-commit",help="git tag/branch/commit hash to migrate to")
     parser.add_argument("--distributionCenter",help="name of distribution center folder to run along with common migrations")
-    parser.add_argument("--migration-id",help="id of migration to generate template")
+    parser.add_argument("--migration-id",help="id of migration to generate template, or to show the history of")
+    parser.add_argument("--template-format",choices=['js','python'],default='js'
+                        ,help='Format of the migration generated by generate_template_migration, default is \'js\'')
     parser.add_argument("-u","--user",help="user name for MongoDB connection, overrides conf connection string")
     parser.add_argument("-p","--password",help="password for MongoDB connection, overrides conf connection string")
     parser.add_argument("--authenticationDatabase",help="user source, --user and --password are required for this argument to be applied")
     parser.add_argument("--dry-run",action='store_true',default=False
                         ,help='Only show what would have been done, don\'t actually do anything')
+    parser.add_argument("--estimate",action='store_true',default=False
+                        ,help='migrate: report the documents and bytes each migration and level would touch, then stop')
     parser.add_argument("--force",action='store_true',default=False
                         ,help='Force an action, override any internal checks')
     parser.add_argument("--verbose",action='store_true',default=False
                         ,help='Enable more verbose logging')
+    parser.add_argument("--no-shell-session",action='store_true',default=False
+                        ,help='Start a new mongo shell process for each script instead of one shell session per run')
+    parser.add_argument("--no-batch-load",action='store_true',default=False
+                        ,help='Load each changed migration with it\'s own shell command instead of one batch')
+    parser.add_argument("--jobs",type=int,default=1
+                        ,help='Number of migrations in the same runAfter level to run at the same time, default is 1')
+    parser.add_argument("--profile",action='store_true',default=False
+                        ,help='Print the time taken by each phase and script of a migrate as JSON')
+    parser.add_argument("--fleet",help="fleet file listing the targets to migrate or verify together, see docs")
+    parser.add_argument("--fleet-jobs",type=int
+                        ,help='Number of fleet targets to migrate at the same time, default is the fleet file concurrency or 4')
+    parser.add_argument("--json",action='store_true',default=False
+                        ,help='status: print the MongoDB status as JSON, without asking git, migrate --estimate: print the estimate as JSON')
+    parser.add_argument("--with-git",action='store_true',default=False
+                        ,help='status: include the git status with --json')
+    parser.add_argument("--script-timeout",type=int
+                        ,help='Seconds an up() or down() may run before it is killed and treated as failed, default is no timeout')
+    parser.add_argument("--heartbeat",type=int
+                        ,help='Seconds between \'still running\' messages for long running scripts, default is 60')
+    parser.add_argument("--max-lag",type=int
+                        ,help='Seconds secondaries may fall behind before batch_update in python migrations slows down and pauses, default is no throttling')
+    parser.add_argument("--snapshot",action='store_true',default=False
+                        ,help='Copy the documents each migration declares it touches before up(), undo restores them after down(), as does a rollback with --snapshot')
+    parser.add_argument("--snapshot-days",type=int,default=7
+                        ,help='Days snapshots are kept before migrate drops them, default is 7')
+    parser.add_argument("--lease",action='store_true',default=False
+                        ,help='migrate: only one node runs the migrate, the others wait for the target commit to be applied, see docs')
+    parser.add_argument("--lease-ttl",type=int,default=60
+                        ,help='Seconds the migrate lease lasts without being renewed, default is 60')
+    parser.add_argument("--plan",help="plan file to write with the plan action, or to take the run order from with migrate")
+    parser.add_argument("--bundle",help="bundle file to write with the bundle action, or to migrate from without git")
+    parser.add_argument("--no-server",action='store_true',default=False
+                        ,help='Run the action here even if mongrate serve is running')
+    parser.add_argument("--run",help="history: run id to show with it's scripts")
+    parser.add_argument("--before",help="history: only show entries which started before this UTC time, e.g. 2017-01-31T12:00:00")
+    parser.add_argument("--limit",type=int,default=20
+                        ,help='history: entries per page, default is 20')
     parser.add_argument("--test-script",help='Internal testing use only')
     parser.add_argument("--test-script-func",help='Internal testing use only')
     # TODO: add more command line options to allow setting security credentials for Mongo connection
@@ -650,6 +2963,11 @@ def main():
     logger.debug("config: " + str(config))
     logger.info("log level set to " + logging.getLevelName(logger.getEffectiveLevel()))
     logger.info("--dry-run is " + str(args.dry_run))
+    if args.action in Mongrate.SERVER_ACTIONS and not args.no_server:
+        reply = forward_to_server(get_server_socket(config),args,logger,config)
+        if reply is not None:
+            sys.stdout.write(reply['output'])
+            sys.exit(0 if reply['ret'] else 1)
     mongrate = Mongrate(config, args, logger)
     logger.info('Mongrate initialized, attempt to perform ' + args.action + ' action')
     try: